@@ -1,36 +1,170 @@
 import os
 import csv
+import json
+import time
+import hashlib
 import sqlite3
 
 import discord
 import asyncio
-from discord.ext import commands
+from typing import Optional
+from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
-from data.db_io import DbHandler
+from data.async_db import AsyncDbHandler
+from data.migrations import migrate
+from data.map_crawler import HttpBackend
+from data.world_sync import WorldSync
+from data.loads import VEHICLES
+from data import metrics
+from data.jobs import IngestQueue, MAX_UPLOAD_BYTES
+from responses import PageCache, chunkRows, chunkLines, respondPages
 
 load_dotenv()
 
+# Metrics are collected unless METRICS=0, with it off nothing is wrapped at all
+if os.getenv('METRICS', '1') != '0':
+    metrics.enable(int(os.getenv('SLOW_QUERY_MS', '100')) / 1000)
+
+class InstrumentedTree(app_commands.CommandTree):
+    """Command tree that times every slash command from dispatch until its handler returns."""
+    async def interaction_check(self, inter: discord.Interaction):
+        inter.extras['started'] = time.perf_counter()
+        return True
+
+    async def on_error(self, inter: discord.Interaction, error: app_commands.AppCommandError):
+        record_command(inter, failed=True)
+        await super().on_error(inter, error)
+
+def record_command(inter: discord.Interaction, failed=False):
+    started = inter.extras.get('started')
+    if started is not None and inter.command is not None:
+        metrics.registry.record('command', inter.command.qualified_name, time.perf_counter() - started, failed=failed)
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='/', intents=intents)
+bot = commands.Bot(
+    command_prefix='/', intents=intents,
+    tree_cls=InstrumentedTree if metrics.enabled else app_commands.CommandTree
+)
 
-db = DbHandler(os.getenv('DB_PATH'))
+migrate(os.getenv('DB_PATH'))
+db = AsyncDbHandler(os.getenv('DB_PATH'))
+world_sync = WorldSync(db, HttpBackend(os.getenv('WAR_API_SHARD', '1')))
+page_cache = PageCache(db.caches.pages)
+ingest = IngestQueue(db)
 sync_commands = True
+# Hash of the last synced command tree, the tree is only synced again once the commands change
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', f"{os.getenv('DB_PATH')}.commands")
+
+# Hashes the command signatures as they are sent to Discord, together with the guild they are synced to
+def command_hash(guild_id):
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c['name'])
+    return hashlib.sha256(json.dumps([guild_id, payload], sort_keys=True).encode()).hexdigest()
+
+# Re-imports hexes whose map data changed, runs alongside commands
+@tasks.loop(minutes=int(os.getenv('WORLD_REFRESH_MINUTES', '15')))
+async def refresh_world():
+    try:
+        stats = await world_sync.refresh()
+    except Exception as e:
+        print(f'World refresh failed: {e}')
+        return
+    if stats['hexes']:
+        print('World refreshed {hexes} hexes: {inserted} new, {updated} moved, {deleted} removed structures'.format(**stats))
+
+# Merges old inventory history so it stays small over a long war
+@tasks.loop(hours=1)
+async def rollup_history():
+    try:
+        await db.rollupHistory()
+    except Exception as e:
+        print(f'History rollup failed: {e}')
+
+# Writes the metrics in Prometheus text format to METRICS_FILE for a node exporter or scraper to pick up
+@tasks.loop(seconds=int(os.getenv('METRICS_INTERVAL', '60')))
+async def write_metrics():
+    try:
+        await asyncio.to_thread(metrics.registry.writePrometheus, os.getenv('METRICS_FILE'))
+    except Exception as e:
+        print(f'Writing metrics failed: {e}')
+
+@bot.event
+async def on_app_command_completion(inter: discord.Interaction, command):
+    record_command(inter)
 
 @bot.event
 async def on_ready():
+    if not refresh_world.is_running():
+        refresh_world.start()
+    if not rollup_history.is_running():
+        rollup_history.start()
+    if metrics.enabled and os.getenv('METRICS_FILE') and not write_metrics.is_running():
+        write_metrics.start()
     if sync_commands:
         guild = discord.Object(id=os.getenv("TESTGUILD_ID"))
+        digest = command_hash(guild.id)
+        try:
+            with open(COMMAND_HASH_FILE) as f:
+                synced = f.read().strip()
+        except OSError:
+            synced = None
+        if synced == digest:
+            print('Commands unchanged, tree sync skipped')
+            return
         bot.tree.copy_global_to(guild=guild)
         await bot.tree.sync(guild=guild)
+        with open(COMMAND_HASH_FILE, 'w') as f:
+            f.write(digest)
         print('Tree synced')
 
 
+# Autocomplete callbacks, answered from the in-memory tries and per-guild caches
+async def town_autocomplete(inter: discord.Interaction, current: str):
+    return [app_commands.Choice(name=t, value=t) for t in db.completeTowns(current)]
+
+
+async def structure_autocomplete(inter: discord.Interaction, current: str):
+    town = getattr(inter.namespace, 'town', None)
+    return [app_commands.Choice(name=t, value=t) for t in db.completeStructureTypes(current, town)]
+
+
+async def stockpile_autocomplete(inter: discord.Interaction, current: str):
+    current = current.strip().casefold()
+    choices = []
+    for stock in await db.listStockpiles(inter.guild_id):
+        label = f"{stock['id']} - {stock['name']} ({stock['type']}, {stock['town']})"
+        if current in label.casefold():
+            choices.append(app_commands.Choice(name=label[:100], value=stock['id']))
+            if len(choices) == 25:
+                break
+    return choices
+
+
+async def preset_autocomplete(inter: discord.Interaction, current: str):
+    current = current.strip().casefold()
+    presets = await db.listPresets(inter.guild_id)
+    return [app_commands.Choice(name=p, value=p) for p in presets if current in p.casefold()][:25]
+
+
+# Completes the item name of the last entry in a "display_name:quantity, ..." list
+async def quota_autocomplete(inter: discord.Interaction, current: str):
+    head, sep, last = current.rpartition(',')
+    if ':' in last:
+        return []
+    head = head + ', ' if sep else ''
+    choices = []
+    for item in db.completeItems(last.strip()):
+        value = f'{head}{item}:'
+        if len(value) <= 100:
+            choices.append(app_commands.Choice(name=value, value=value))
+    return choices
+
+
 @bot.tree.command(name='register', description='Register this discord server with the bot')
 async def register(inter: discord.Interaction):
     try:
-        db.addGuild(inter.guild_id, inter.guild.name)
+        await db.addGuild(inter.guild_id, inter.guild.name)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -39,32 +173,82 @@ async def register(inter: discord.Interaction):
 
 @bot.tree.command(name='list', description='List all stockpiles registered on the discord server')
 async def list(inter: discord.Interaction):
+    async def render():
+        stockpiles = await db.fetchStockpiles(inter.guild_id)
+        rows = [f"{stock['id']: <8} | {stock['name']: <12} | {stock['town']: <12} | {stock['type']}" for stock in stockpiles]
+        return chunkRows('Stock ID |     Name     |     Town     | Type \n--------------------------------------------------', rows)
+    await respondPages(inter, render, page_cache, ('list',))
+
+
+@bot.tree.command(name='nearest', description='List the stockpiles closest to a town')
+@app_commands.autocomplete(town=town_autocomplete)
+async def nearest(inter: discord.Interaction, town: str):
+    async def render():
+        stockpiles = await db.nearestStockpiles(inter.guild_id, town)
+        rows = [
+            f"{stock['id']: <8} | {stock['name']: <12} | {stock['town']: <12} | {stock['distance']: <8.3f} | {stock['type']}"
+            for stock in stockpiles
+        ]
+        return chunkRows('Stock ID |     Name     |     Town     | Distance | Type \n------------------------------------------------------------', rows)
+    await respondPages(inter, render, page_cache, ('nearest', town))
+
+
+@bot.tree.command(name='create', description='Add a new stockpile in the bot')
+@app_commands.autocomplete(town=town_autocomplete, type=structure_autocomplete)
+async def create(inter: discord.Interaction, town: str, type: str, name: str):
     try:
-        stockpiles = db.fetchStockpiles(inter.guild_id)
+        await db.create(inter.guild_id, town, type, name)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
-    stock_list = ['```Stock ID |     Name     |     Town     | Type \n--------------------------------------------------']
-    for stock in stockpiles:
-        stock_list.append(f"{stock['id']: <8} | {stock['name']: <12} | {stock['town']: <12} | {stock['type']}")
-    stock_str = '\n'.join(stock_list)+'```'
-    await inter.response.send_message(stock_str)
+    await inter.response.send_message(f"Created stockpile named {name} at the {type} in {town}")
 
 
-@bot.tree.command(name='create', description='Add a new stockpile in the bot')
-async def create(inter: discord.Interaction, town: str, type: str, name: str):
+# Commands whose effect or output spans every server are left to the bot owner, reason tells everyone else why
+async def check_owner(inter: discord.Interaction, reason: str):
+    if await bot.is_owner(inter.user):
+        return True
+    await inter.response.send_message(reason, ephemeral=True)
+    return False
+
+ROUTE_OWNER_ONLY = 'Roads are shared by every server, only the bot owner can change them'
+
+
+@bot.tree.command(name='addroute', description='Add or update the road between two towns, the length is estimated within a region when left empty')
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+@app_commands.autocomplete(from_town=town_autocomplete, to_town=town_autocomplete)
+async def addroute(inter: discord.Interaction, from_town: str, to_town: str, length: Optional[int] = None):
+    if not await check_owner(inter, ROUTE_OWNER_ONLY):
+        return
     try:
-        db.create(inter.guild_id, town, type, name)
+        length = await db.addRoute(inter.guild_id, from_town, to_town, length)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
-    await inter.response.send_message(f"Created stockpile named {name} at the {type} in {town}")
+    await inter.response.send_message(f"Route from {from_town} to {to_town} set to {length}m")
+
+
+@bot.tree.command(name='deleteroute', description='Delete the road between two towns')
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+@app_commands.autocomplete(from_town=town_autocomplete, to_town=town_autocomplete)
+async def deleteroute(inter: discord.Interaction, from_town: str, to_town: str):
+    if not await check_owner(inter, ROUTE_OWNER_ONLY):
+        return
+    try:
+        await db.deleteRoute(inter.guild_id, from_town, to_town)
+    except ValueError as e:
+        await inter.response.send_message(str(e), ephemeral=True)
+        return
+    await inter.response.send_message(f"Deleted route from {from_town} to {to_town}")
 
 
 @bot.tree.command(name='delete', description='Delete a stockpile from the bot')
+@app_commands.autocomplete(stock_id=stockpile_autocomplete)
 async def delete(inter: discord.Interaction, stock_id: int):
     try:
-        db.delete(inter.guild_id, stock_id)
+        await db.delete(inter.guild_id, stock_id)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -73,9 +257,10 @@ async def delete(inter: discord.Interaction, stock_id: int):
 
 @bot.tree.command(name='addquotas', description="""Adds quotas to a stockpile. 
 quota_list in the form \"display_name:quantity, display_name:quantity\"""")
+@app_commands.autocomplete(stock_id=stockpile_autocomplete, quota_list=quota_autocomplete)
 async def addQuotas(inter: discord.Interaction, stock_id: int, quota_list: str):
     try:
-        db.addQuotas(inter.guild_id, stock_id, quota_list)
+        await db.addQuotas(inter.guild_id, stock_id, quota_list)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -83,9 +268,10 @@ async def addQuotas(inter: discord.Interaction, stock_id: int, quota_list: str):
 
 
 @bot.tree.command(name='deletequotas', description="Removes all quotas for a stockpile.")
+@app_commands.autocomplete(stock_id=stockpile_autocomplete)
 async def deleteQuotas(inter: discord.Interaction, stock_id: int):
     try:
-        db.deleteQuotas(inter.guild_id, stock_id)
+        await db.deleteQuotas(inter.guild_id, stock_id)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -93,24 +279,21 @@ async def deleteQuotas(inter: discord.Interaction, stock_id: int):
 
 
 @bot.tree.command(name='listquotas', description='List the quotas that are set on a stockpile')
+@app_commands.autocomplete(stock_id=stockpile_autocomplete)
 async def listQuotas(inter: discord.Interaction, stock_id: int):
-    try:
-        quota_list = db.fetchQuotas(inter.guild_id, stock_id)
-    except ValueError as e:
-        await inter.response.send_message(str(e), ephemeral=True)
-        return
-    quota_set_string = 'Quota set string:\n'+', '.join([f"{q['display_name']}:{q['quantity']}" for q in quota_list])
-    quota_table = ['```Name                    | Quantity \n------------------------------']
-    for q in quota_list:
-        quota_table.append(f"{q['display_name']: <23} | {q['quantity']}")
-    quota_string = '\n'.join(quota_table)+'\n\n'+quota_set_string+'```'
-    await inter.response.send_message(quota_string)
+    async def render():
+        quota_list = await db.fetchQuotas(inter.guild_id, stock_id)
+        rows = [f"{q['display_name']: <23} | {q['quantity']}" for q in quota_list]
+        rows += ['', 'Quota set string:', ', '.join([f"{q['display_name']}:{q['quantity']}" for q in quota_list])]
+        return chunkRows('Name                    | Quantity \n------------------------------', rows)
+    await respondPages(inter, render, page_cache, ('listquotas', stock_id))
 
 
 @bot.tree.command(name='createpreset', description='Create a quota preset')
+@app_commands.autocomplete(quota_list=quota_autocomplete)
 async def createPreset(inter: discord.Interaction, preset_name: str, quota_list:str):
     try:
-        db.createPreset(inter.guild_id, preset_name, quota_list)
+        await db.createPreset(inter.guild_id, preset_name, quota_list)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -118,9 +301,10 @@ async def createPreset(inter: discord.Interaction, preset_name: str, quota_list:
 
 
 @bot.tree.command(name='deletepreset', description='Deletes a named preset (does not remove from active quotas)')
+@app_commands.autocomplete(preset_name=preset_autocomplete)
 async def deletePreset(inter: discord.Interaction, preset_name: str):
     try:
-        db.deletePreset(inter.guild_id, preset_name)
+        await db.deletePreset(inter.guild_id, preset_name)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
@@ -128,57 +312,219 @@ async def deletePreset(inter: discord.Interaction, preset_name: str):
 
 
 @bot.tree.command(name='applypreset', description='Adds a preset quota to a stockpile (does not overwrite existing quotas)')
-async def applyPreset(inter: discord.Interaction, stock_id: str, preset_name: str):
+@app_commands.autocomplete(stock_id=stockpile_autocomplete, preset_name=preset_autocomplete)
+async def applyPreset(inter: discord.Interaction, stock_id: int, preset_name: str):
     try:
-        db.applyPreset(inter.guild_id, stock_id, preset_name)
+        await db.applyPreset(inter.guild_id, stock_id, preset_name)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
     await inter.response.send_message(f"Preset {preset_name} added to stockpile with id {stock_id}")
 
 
-@bot.tree.command(name='requirements', description='Get the requirements from all stockpiles')
-async def requirements(inter: discord.Interaction):
+@bot.tree.command(name='applypresettype', description='Adds a preset quota to every stockpile at a structure type (does not overwrite existing quotas)')
+@app_commands.autocomplete(structure_type=structure_autocomplete, preset_name=preset_autocomplete)
+async def applyPresetToType(inter: discord.Interaction, structure_type: str, preset_name: str):
     try:
-        req_dict = db.getRequirements(inter.guild_id)
+        count = await db.applyPresetToType(inter.guild_id, structure_type, preset_name)
     except ValueError as e:
         await inter.response.send_message(str(e), ephemeral=True)
         return
-    if not req_dict:
-        await inter.response.send_message('No requirements found', ephemeral=True)
-        return
-    req_list = ['```Stock ID | Quantity |  Crates Needed \n----------------------------------------------']
-    for stock_id, reqs in req_dict.items():
-        for item, quantity in reqs['requirements'].items():
-            req_list.append(f"{stock_id: <8} | {quantity: <8} | {item} ")
-    req_str = '\n'.join(req_list)+'```'
-    await inter.response.send_message(req_str)
+    await inter.response.send_message(f"Preset {preset_name} added to {count} stockpiles at a {structure_type}")
 
-  
-@bot.tree.command(name='update', description='Update the inventory of a stockpile using a TSV file')
-async def update(inter: discord.Interaction, stock_id: int):
-    # Prompt user for TSV file
-    await inter.response.send_message("Please reply with your TSV file.")
-    def check(msg):
-        return msg.author == inter.user and msg.attachments
+
+@bot.tree.command(name='requirements', description='Get the requirements from all stockpiles, nearest to source first when given')
+@app_commands.autocomplete(source=town_autocomplete)
+async def requirements(inter: discord.Interaction, source: Optional[str] = None):
+    async def render():
+        req_dict = await db.getRequirements(inter.guild_id, source)
+        if not req_dict:
+            raise ValueError('No requirements found')
+        rows = []
+        for stock_id, reqs in req_dict.items():
+            for item, quantity in reqs['requirements'].items():
+                if source is None:
+                    rows.append(f"{stock_id: <8} | {quantity: <8} | {item} ")
+                else:
+                    distance = '-' if reqs['distance'] == float('inf') else f"{reqs['distance']}m"
+                    rows.append(f"{stock_id: <8} | {distance: <8} | {quantity: <8} | {item} ")
+        if source is None:
+            return chunkRows('Stock ID | Quantity |  Crates Needed \n----------------------------------------------', rows)
+        return chunkRows('Stock ID | Distance | Quantity |  Crates Needed \n---------------------------------------------------------', rows)
+    await respondPages(inter, render, page_cache, ('requirements', source))
+
+
+@bot.tree.command(name='tasks', description='List the open and claimed logistics tasks, highest priority first')
+async def tasks_list(inter: discord.Interaction):
+    async def render():
+        task_list = await db.fetchTasks(inter.guild_id)
+        if not task_list:
+            raise ValueError('No open tasks')
+        rows = [
+            f"{task['id']: <7} | {task['stock_id']: <8} | {task['crates']: <6} | {task['status']: <7} | {task['item']}"
+            for task in task_list
+        ]
+        return chunkRows('Task ID | Stock ID | Crates | Status  | Item \n----------------------------------------------------', rows)
+    await respondPages(inter, render, page_cache, ('tasks',))
+
+
+@bot.tree.command(name='claim', description='Claim the highest priority open logistics task')
+async def claim(inter: discord.Interaction):
     try:
-        msg = await bot.wait_for("message", check=check, timeout=60)  # Wait for 60s
-    except asyncio.TimeoutError:
-        await inter.followup.send("File upload timed out.", ephemeral=True)
+        task = await db.claimTask(inter.guild_id, inter.user.id)
+    except ValueError as e:
+        await inter.response.send_message(str(e), ephemeral=True)
         return
+    await inter.response.send_message(
+        f"Task {task['id']} claimed by {inter.user.display_name}: haul {task['crates']} crates of {task['item']} "
+        f"to {task['stock_name']} (stock ID {task['stock_id']}) in {task['town']}"
+    )
+
 
-    # Ingest TSV file
-    attachment = msg.attachments[0]
-    if 'text/tab-separated-values' not in attachment.content_type:
-        await inter.followup.send('Error: File must be a TSV, not {}'.format(attachment.content_type), ephemeral=True)
+@bot.tree.command(name='complete', description='Mark a task you claimed as delivered')
+async def complete(inter: discord.Interaction, task_id: int):
+    try:
+        await db.completeTask(inter.guild_id, inter.user.id, task_id)
+    except ValueError as e:
+        await inter.response.send_message(str(e), ephemeral=True)
         return
-    tsvFile = await attachment.read()
-    tsvFile = tsvFile.decode('utf-8').splitlines()
+    await inter.response.send_message(f"Task {task_id} completed")
+
+
+@bot.tree.command(name='sethub', description='Set the town task priorities measure road distance from')
+@app_commands.autocomplete(town=town_autocomplete)
+async def sethub(inter: discord.Interaction, town: str):
     try:
-        db.updateInventory(inter.guild_id, stock_id, tsvFile)
+        await db.setHub(inter.guild_id, town)
     except ValueError as e:
-        await inter.followup.send(str(e), ephemeral=True)
+        await inter.response.send_message(str(e), ephemeral=True)
+        return
+    await inter.response.send_message(f"Task distances are now measured from {town}")
+
+
+@bot.tree.command(name='production', description='List what the factories need to build to cover every quota, and the raw materials for it')
+async def production(inter: discord.Interaction):
+    async def render():
+        plan = await db.production(inter.guild_id)
+        if not plan['queues'] and not plan['unbuildable']:
+            raise ValueError('Nothing needs to be produced')
+        rows = []
+        for queue in plan['queues']:
+            rows.append(f"{queue['building']} - {queue['queue']}")
+            for item, crates in queue['items'].items():
+                rows.append(f"  {crates: >4} crates | {item}")
+            rows.append('  Needs: ' + ', '.join(f"{quantity} {name}" for name, quantity in queue['materials'].items()))
+        if plan['unbuildable']:
+            rows.append('Unbuildable - no recipe in the catalog')
+            for item, crates in plan['unbuildable'].items():
+                rows.append(f"  {crates: >4} crates | {item}")
+        return chunkRows('', rows)
+    await respondPages(inter, render, page_cache, ('production',))
+
+
+@bot.tree.command(name='loads', description='Pack every quota deficit into vehicle trips, grouped by destination town')
+@app_commands.choices(vehicle=[app_commands.Choice(name=v.name, value=k) for k, v in VEHICLES.items()])
+async def loads(inter: discord.Interaction, vehicle: Optional[app_commands.Choice[str]] = None):
+    vehicle = vehicle.value if vehicle else 'truck'
+    async def render():
+        plan = await db.planLoads(inter.guild_id, vehicle)
+        if not plan['trips']:
+            raise ValueError(f"Nothing for a {plan['vehicle']} to haul")
+        rows = []
+        for n, trip in enumerate(plan['trips'], 1):
+            rows.append(f"Trip {n} - {trip['town']} ({trip['crates']}/{plan['slots']})")
+            for lot in trip['loads']:
+                rows.append(f"  {lot.crates: >3} x {lot.item} -> {lot.stock_name} (stock ID {lot.stock_id})")
+        if plan['skipped']:
+            rows.append(f"{plan['skipped']} crates need another vehicle class")
+        return chunkRows(f"{len(plan['trips'])} {plan['vehicle']} trips", rows)
+    await respondPages(inter, render, page_cache, ('loads', vehicle))
+
+
+@bot.tree.command(name='forecast', description='List the items that will fall below their quota soonest at the current burn rate')
+@app_commands.autocomplete(stock_id=stockpile_autocomplete)
+async def forecast(inter: discord.Interaction, stock_id: Optional[int] = None):
+    # Burn rates move with the clock as well as with writes, so forecasts are never cached
+    async def render():
+        forecasts = await db.forecast(inter.guild_id, stock_id, limit=100)
+        if not forecasts:
+            raise ValueError('Not enough inventory history to forecast yet')
+        rows = []
+        for fc in forecasts:
+            below = 'now' if fc['hours_left'] == 0 else f"{fc['hours_left']:.1f}h"
+            rows.append(f"{fc['stock_id']: <8} | {fc['crates']: <6} | {fc['quota']: <5} | {fc['per_hour']: <8.1f} | {below: <11} | {fc['item']}")
+        return chunkRows('Stock ID | Crates | Quota | Crates/h | Below Quota | Item \n----------------------------------------------------------------', rows)
+    await respondPages(inter, render)
+
+  
+@bot.tree.command(name='stats', description='Show command latencies, database call costs and slow queries')
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def stats(inter: discord.Interaction):
+    if not await check_owner(inter, 'Metrics cover every server the bot is in, only the bot owner can see them'):
+        return
+    if not metrics.enabled:
+        await inter.response.send_message('Metrics are turned off, start the bot without METRICS=0 to collect them', ephemeral=True)
+        return
+    async def render():
+        calls, slow = metrics.registry.snapshot()
+        if not calls['command'] and not calls['db']:
+            raise ValueError('No calls recorded yet')
+        pages = []
+        # Slowest in total first, that is where time goes
+        rows = [
+            f"{name[:16]: <16} | {s.count: <6} | {s.failed: <6} | {s.quantile(0.5) * 1000: <7.1f} | {s.quantile(0.95) * 1000: <7.1f} | {s.max * 1000:.1f}"
+            for name, s in sorted(calls['command'].items(), key=lambda c: c[1].seconds, reverse=True)
+        ]
+        if rows:
+            pages += chunkRows('Command          | Calls  | Failed | p50 ms  | p95 ms  | Max ms\n----------------------------------------------------------------', rows)
+        rows = [
+            f"{name[:20]: <20} | {s.count: <6} | {s.queries / s.count: <9.1f} | {s.rows / s.count: <8.1f} | {s.quantile(0.95) * 1000: <7.1f} | {s.max * 1000:.1f}"
+            for name, s in sorted(calls['db'].items(), key=lambda c: c[1].seconds, reverse=True)
+        ]
+        if rows:
+            pages += chunkRows('DB call              | Calls  | Queries/c | Rows/c   | p95 ms  | Max ms\n-------------------------------------------------------------------------', rows)
+        if slow:
+            rows = []
+            for q in slow:
+                rows.append(f"{q['seconds'] * 1000:.1f} ms in {q['method']}: {q['sql'][:300]} {q['params']}")
+            pages += chunkRows(f'Slow queries (over {metrics.registry.slow_query_seconds * 1000:.0f} ms), newest first', rows)
+        return pages
+    await respondPages(inter, render)
+
+
+@bot.tree.command(name='update', description='Update stockpile inventories from a TSV file, leave stock_id empty to update every stockpile in it')
+@app_commands.autocomplete(stock_id=stockpile_autocomplete)
+async def update(inter: discord.Interaction, file: discord.Attachment, stock_id: Optional[int] = None):
+    if 'text/tab-separated-values' not in (file.content_type or ''):
+        await inter.response.send_message('Error: File must be a TSV, not {}'.format(file.content_type), ephemeral=True)
+        return
+    if file.size > MAX_UPLOAD_BYTES:
+        await inter.response.send_message(f'Error: File is too large, the limit is {MAX_UPLOAD_BYTES // 1024} KiB', ephemeral=True)
         return
-    await inter.followup.send('Updated stockpile with ID {}'.format(stock_id))
 
-bot.run(os.getenv('TOKEN'))
\ No newline at end of file
+    # Sends the result as a follow-up once the job finishes
+    async def report(job):
+        if job.error is not None:
+            await inter.followup.send(f'Update job {job.id} failed: {job.error}', ephemeral=True)
+            return
+        if job.stock_id is not None:
+            await inter.followup.send(
+                'Update job {}: updated stockpile with ID {} ({inserted} new, {changed} changed, {unchanged} unchanged, {zeroed} zeroed)'
+                .format(job.id, job.stock_id, **job.result)
+            )
+            return
+        lines = [f'Update job {job.id}:']
+        lines += [
+            'Updated stockpile {name} ({type}) with ID {stock_id} ({inserted} new, {changed} changed, {unchanged} unchanged, {zeroed} zeroed)'
+            .format(**stats) for stats in job.result['updated']
+        ]
+        lines += ['Skipped unknown stockpile {name} ({type})'.format(**s) for s in job.result['unmatched']]
+        for page in chunkLines(lines):
+            await inter.followup.send(page)
+
+    job = ingest.submit(inter.guild_id, stock_id, file.read, report)
+    await inter.response.send_message(f'Queued update job {job.id} for {file.filename}')
+
+if __name__ == "__main__":
+    bot.run(os.getenv('TOKEN'))
\ No newline at end of file
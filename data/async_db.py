@@ -0,0 +1,258 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from data.cache import Caches
+from data.db_io import DbHandler
+
+READ_POOL_SIZE = 4
+# A write waits at most BATCH_WINDOW seconds for others to share its commit, batches hold up to BATCH_SIZE writes
+BATCH_WINDOW = 0.01
+BATCH_SIZE = 64
+# Writes that change what every guild sees, every other write only changes the guild passed as its first argument
+SHARED_WRITES = {'syncHexes', 'rollupHistory', 'addRoute', 'deleteRoute'}
+
+class AsyncDbHandler():
+    """Awaitable DbHandler that keeps sqlite work off the event loop.
+
+    Reads are spread over a pool of threads that each own a connection,
+    writes go through a single writer thread so they are applied one at a time.
+    All handlers share one Caches instance so invalidations reach every reader.
+
+    Writes are queued and committed in batches: a batch goes out once it has
+    waited batch_window seconds or holds batch_size writes, and writes queued
+    while a batch is committing form the next one. A write's awaitable only
+    resolves after its batch has committed, so a reply sent after awaiting it
+    is only sent for data that is on disk.
+    """
+    def __init__(self, db_file, read_pool_size=READ_POOL_SIZE, batch_window=BATCH_WINDOW, batch_size=BATCH_SIZE):
+        self.db_file = db_file
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.caches = Caches()
+        self._local = threading.local()
+        self._handlers = []
+        self._handlers_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix='db-read')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        # Queued writes as (method, args, future), the batch being committed and the pending flush timer
+        self._pending = deque()
+        self._flushing = None
+        self._timer = None
+        # Build the static indexes up front so autocomplete never waits on them
+        self._writer.submit(self._setupWriter).result()
+
+    # Batches pay for one fsync each, so the writer can afford full durability on every commit
+    def _setupWriter(self):
+        self._handler().cur.execute("PRAGMA synchronous = FULL")
+
+    # Returns the DbHandler owned by the calling executor thread
+    def _handler(self):
+        handler = getattr(self._local, 'handler', None)
+        if handler is None:
+            handler = DbHandler(self.db_file, self.caches)
+            self._local.handler = handler
+            with self._handlers_lock:
+                self._handlers.append(handler)
+        return handler
+
+    def _call(self, method, args):
+        return getattr(self._handler(), method)(*args)
+
+    async def _read(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._call, method, args)
+
+    # Queues a write and waits until the batch carrying it is committed
+    async def _write(self, method, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((method, args, future))
+        if self._flushing is None:
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    # Sends the oldest queued writes to the writer thread as one batch, one batch is in flight at a time
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            write = self._pending.popleft()
+            # Writes whose caller gave up before they were sent are dropped
+            if not write[2].cancelled():
+                batch.append(write)
+        if batch:
+            self._flushing = asyncio.ensure_future(self._commitBatch(batch))
+
+    async def _commitBatch(self, batch):
+        loop = asyncio.get_running_loop()
+        calls = [(method, args) for method, args, _ in batch]
+        try:
+            results = await loop.run_in_executor(self._writer, self._runBatch, calls)
+        except Exception as e:
+            # The commit itself failed, nothing in the batch was written
+            results = [(False, e)] * len(batch)
+        self._dropPages(calls, results)
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        self._flushing = None
+        # Writes that queued up during the commit have waited long enough, they go out straight away
+        if self._pending:
+            self._flush()
+
+    # Drops the rendered pages of every guild a committed write changed
+    def _dropPages(self, calls, results):
+        for (method, args), (ok, _) in zip(calls, results):
+            if not ok:
+                continue
+            if method in SHARED_WRITES:
+                self.caches.pages.clear()
+            else:
+                self.caches.pages.invalidate(args[0])
+
+    def _runBatch(self, calls):
+        return self._handler().runBatch(calls)
+
+    # Waits until every queued write is committed
+    async def drain(self):
+        while self._pending or self._flushing is not None:
+            if self._flushing is None:
+                self._flush()
+            await asyncio.shield(self._flushing)
+
+    # Waits for queued work to finish and releases every connection
+    # Connections are bound to their executor thread, so they are dropped rather than closed here
+    # Writes still queued on the event loop are not waited for, await drain() first
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._handlers_lock:
+            self._handlers.clear()
+
+    # Autocomplete lookups, answered from memory without touching sqlite
+    def completeTowns(self, prefix, limit=25):
+        return self.caches.towns.complete(prefix, limit)
+
+    def completeItems(self, prefix, limit=25):
+        return self.caches.items.complete(prefix, limit)
+
+    # Structure types, restricted to the ones present in town when it is known
+    def completeStructureTypes(self, prefix, town=None, limit=25):
+        types = self.caches.structure_types.complete(prefix, limit)
+        in_town = self.caches.town_structures.get(town)
+        if in_town is not None:
+            types = [t for t in types if t in in_town]
+        return types
+
+    # Per-guild lists are served from the cache and only loaded on a miss
+    async def listStockpiles(self, guild_id):
+        directory = self.caches.stockpiles.get(guild_id)
+        if directory is None:
+            return await self._read('listStockpiles', guild_id)
+        return tuple(directory.values())
+
+    async def nearestStockpiles(self, guild_id, town, limit=5):
+        return await self._read('nearestStockpiles', guild_id, town, limit)
+
+    async def listPresets(self, guild_id):
+        presets = self.caches.presets.get(guild_id)
+        if presets is None:
+            presets = await self._read('listPresets', guild_id)
+        return presets
+
+    async def addGuild(self, guild_id, name):
+        return await self._write('addGuild', guild_id, name)
+
+    async def fetchStockpiles(self, guild_id):
+        return await self._read('fetchStockpiles', guild_id)
+
+    async def create(self, guild_id, town, type, name):
+        return await self._write('create', guild_id, town, type, name)
+
+    async def delete(self, guild_id, stock_id):
+        return await self._write('delete', guild_id, stock_id)
+
+    async def updateInventory(self, guild_id, stock_id, tsv_file):
+        return await self._write('updateInventory', guild_id, stock_id, tsv_file)
+
+    async def updateInventories(self, guild_id, tsv_file):
+        return await self._write('updateInventories', guild_id, tsv_file)
+
+    async def ingestInventory(self, guild_id, stock_id, items):
+        return await self._write('ingestInventory', guild_id, stock_id, items)
+
+    async def ingestInventories(self, guild_id, groups):
+        return await self._write('ingestInventories', guild_id, groups)
+
+    async def addQuotas(self, guild_id, stock_id, quota_data):
+        return await self._write('addQuotas', guild_id, stock_id, quota_data)
+
+    async def deleteQuotas(self, guild_id, stock_id):
+        return await self._write('deleteQuotas', guild_id, stock_id)
+
+    async def fetchQuotas(self, guild_id, stock_id):
+        return await self._read('fetchQuotas', guild_id, stock_id)
+
+    async def createPreset(self, guild_id, preset_name, quota_data):
+        return await self._write('createPreset', guild_id, preset_name, quota_data)
+
+    async def deletePreset(self, guild_id, preset_name):
+        return await self._write('deletePreset', guild_id, preset_name)
+
+    async def applyPreset(self, guild_id, stock_id, preset_name):
+        return await self._write('applyPreset', guild_id, stock_id, preset_name)
+
+    async def applyPresetToType(self, guild_id, structure_type, preset_name):
+        return await self._write('applyPresetToType', guild_id, structure_type, preset_name)
+
+    async def fetchTasks(self, guild_id, limit=None):
+        return await self._read('fetchTasks', guild_id, limit)
+
+    async def claimTask(self, guild_id, user_id):
+        return await self._write('claimTask', guild_id, user_id)
+
+    async def completeTask(self, guild_id, user_id, task_id):
+        return await self._write('completeTask', guild_id, user_id, task_id)
+
+    async def setHub(self, guild_id, town):
+        return await self._write('setHub', guild_id, town)
+
+    async def production(self, guild_id):
+        return await self._read('production', guild_id)
+
+    async def planLoads(self, guild_id, vehicle='truck'):
+        return await self._read('planLoads', guild_id, vehicle)
+
+    async def forecast(self, guild_id, stock_id=None, limit=None):
+        return await self._read('forecast', guild_id, stock_id, limit)
+
+    async def rollupHistory(self):
+        return await self._write('rollupHistory')
+
+    async def fetchHexState(self):
+        return await self._read('fetchHexState')
+
+    async def syncHexes(self, results):
+        return await self._write('syncHexes', results)
+
+    async def getRequirements(self, guild_id, source=None):
+        if source is None:
+            return await self._read('getRequirements', guild_id)
+        return await self._read('getRequirementsFrom', guild_id, source)
+
+    async def addRoute(self, guild_id, from_town, to_town, length=None):
+        return await self._write('addRoute', guild_id, from_town, to_town, length)
+
+    async def deleteRoute(self, guild_id, from_town, to_town):
+        return await self._write('deleteRoute', guild_id, from_town, to_town)
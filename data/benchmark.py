@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from data.db_io import DbHandler, TSV_HEADER
+from data.init_db import init_db_tables, bulk_connection, insertMap, load_catalog
+
+# (guilds, stockpiles per guild) for each named scale
+SCALES = {
+    'small': (100, 10),
+    'medium': (1000, 10),
+    'large': (2000, 15),
+}
+CATALOG_SIZE = 400
+RAW_MATERIALS = ('Basic Materials', 'Explosive Powder', 'Heavy Explosive Powder', 'Refined Materials', 'Diesel')
+STRUCTURE_TYPES = ('Seaport', 'Storage Depot')
+TOWNS = 150
+# Quotas per stockpile and preset, inventory rows per stockpile and per uploaded TSV
+QUOTAS = 20
+INVENTORY = 60
+TSV_ROWS = 120
+
+# FIR catalog json entries, the last few items are raw materials and everything else costs some of them
+def syntheticCatalog(rng, size=CATALOG_SIZE):
+    catalog = [
+        {'CodeName': f'Raw{i}', 'DisplayName': name, 'ItemCategory': 'Supplies',
+         'ItemDynamicData': {'QuantityPerCrate': 100}}
+        for i, name in enumerate(RAW_MATERIALS)
+    ]
+    for i in range(size - len(RAW_MATERIALS)):
+        cost = [{'ItemCodeName': f'Raw{r}', 'Quantity': rng.randint(5, 150)} for r in rng.sample(range(len(RAW_MATERIALS)), 2)]
+        catalog.append({
+            'CodeName': f'Item{i}',
+            'DisplayName': f'Item {i}',
+            'ItemCategory': rng.choice(('SmallArms', 'HeavyArms', 'Supplies', 'Medical')),
+            'ItemDynamicData': {'QuantityPerCrate': rng.choice((5, 10, 20, 40)), 'CostPerCrate': cost},
+            'ProductionCategories': {'Factory': rng.choice(('Small Arms', 'Heavy Arms', 'Heavy Ammunition', 'Utilities'))},
+        })
+    return catalog
+
+# Rows of a FIR TSV export for one stockpile, in TSV_HEADER column order
+def syntheticTsv(rng, name, struct_type, items, rows=TSV_ROWS):
+    lines = [TSV_HEADER]
+    for code_name, display_name, per_crate in rng.sample(items, min(rows, len(items))):
+        crated = rng.random() < 0.8
+        quantity = rng.randint(1, 60) if crated else rng.randint(1, 500)
+        total = quantity * per_crate if crated else quantity
+        lines.append('\t'.join((
+            'Public', name, struct_type, str(quantity), display_name,
+            'true' if crated else 'false', str(per_crate), str(total), '', code_name
+        )))
+    return '\n'.join(lines) + '\n'
+
+# Builds a database at db_path through the real migrations, map and catalog loaders, then bulk inserts guild data
+# Returns the items as [(code_name, display_name, per_crate)] and the guilds as {guild_id: [stock_id]}
+def buildDatabase(db_path, guilds, per_guild, seed=0):
+    rng = random.Random(seed)
+    init_db_tables(db_path)
+
+    major_labels = {
+        f'Town {t}': {
+            'region': f'Region{t // 10}', 'x': rng.random(), 'y': rng.random(),
+            'structures': [{'type': s, 'x': rng.random(), 'y': rng.random()} for s in STRUCTURE_TYPES],
+        } for t in range(TOWNS)
+    }
+    catalog_file = os.path.join(os.path.dirname(db_path), 'catalog.json')
+    with open(catalog_file, 'w', encoding='utf-8') as f:
+        json.dump(syntheticCatalog(rng), f)
+    with bulk_connection(db_path, fresh=True) as cursor:
+        insertMap(cursor, major_labels)
+    load_catalog(db_path, catalog_file, fresh=True)
+
+    with bulk_connection(db_path, fresh=True) as cursor:
+        cursor.execute("SELECT id, code_name, display_name, per_crate FROM items WHERE code_name LIKE 'Item%'")
+        items = cursor.fetchall()
+        cursor.execute("SELECT id FROM structures")
+        structure_ids = [r[0] for r in cursor.fetchall()]
+
+        cursor.executemany("INSERT INTO guilds (id, name) VALUES (?, ?)", ((g, f'Guild {g}') for g in range(1, guilds + 1)))
+        stockpiles = []
+        layout = {}
+        for guild_id in range(1, guilds + 1):
+            for n in range(per_guild):
+                stock_id = len(stockpiles) + 1
+                stockpiles.append((stock_id, f'Stockpile {n}', guild_id, rng.choice(structure_ids)))
+                layout.setdefault(guild_id, []).append(stock_id)
+        cursor.executemany("INSERT INTO stockpiles (id, name, guild_id, structure_id) VALUES (?, ?, ?, ?)", stockpiles)
+
+        def quotaRows():
+            for stock_id, _, _, _ in stockpiles:
+                for item in rng.sample(items, QUOTAS):
+                    yield (stock_id, item[0], rng.randint(10, 200))
+        def inventoryRows():
+            for stock_id, _, _, _ in stockpiles:
+                for item in rng.sample(items, INVENTORY):
+                    yield (item[0], stock_id, rng.randint(0, 150), rng.randint(0, 300))
+        cursor.executemany("INSERT INTO quotas (stock_id, item_id, amount) VALUES (?, ?, ?)", quotaRows())
+        cursor.executemany("INSERT INTO inventory (item_id, stock_id, crates, non_crates) VALUES (?, ?, ?, ?)", inventoryRows())
+
+        presets = []
+        preset_items = []
+        for guild_id in range(1, guilds + 1):
+            chosen = [(item, rng.randint(10, 200)) for item in rng.sample(items, QUOTAS)]
+            presets.append((f'preset-{guild_id}', ', '.join(f'{item[2]}:{amount}' for item, amount in chosen), guild_id))
+            preset_items += [(f'preset-{guild_id}', item[0], amount) for item, amount in chosen]
+        cursor.executemany("INSERT INTO presets (name, quota_string, guild_id) VALUES (?, ?, ?)", presets)
+        cursor.executemany("INSERT INTO preset_items (preset, item_id, amount) VALUES (?, ?, ?)", preset_items)
+        cursor.execute("ANALYZE")
+    return [item[1:] for item in items], layout
+
+# Runs op(i) `runs` times and returns its latency summary in milliseconds
+def timeOp(op, runs):
+    samples = []
+    for i in range(runs):
+        start = time.perf_counter()
+        op(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'runs': runs,
+        'mean_ms': round(sum(samples) / runs, 3),
+        'p50_ms': round(samples[runs // 2], 3),
+        'p95_ms': round(samples[min(int(runs * 0.95), runs - 1)], 3),
+        'max_ms': round(samples[-1], 3),
+    }
+
+# Times the DbHandler operations against one database
+# Each operation gets a fresh handler and every run a different guild where there are enough,
+# so reads measure the per-guild caches being filled rather than served
+def runScale(db_path, items, layout, runs, seed=0):
+    rng = random.Random(seed + 1)
+    guild_ids = list(layout)
+
+    def pick():
+        guild_order = rng.sample(guild_ids, min(runs, len(guild_ids)))
+        return [(guild_id, rng.choice(layout[guild_id])) for guild_id in (guild_order[i % len(guild_order)] for i in range(runs))]
+
+    def timeFresh(method, args_list):
+        db = DbHandler(db_path)
+        try:
+            return timeOp(lambda i: getattr(db, method)(*args_list[i]), runs)
+        finally:
+            db.conn.close()
+
+    results = {}
+    targets = pick()
+    tsvs = [syntheticTsv(rng, f'Stockpile {stock_id}', 'Seaport', items).splitlines(keepends=True) for _, stock_id in targets]
+    results['updateInventory'] = timeFresh('updateInventory', [(g, s, tsv) for (g, s), tsv in zip(targets, tsvs)])
+    results['getRequirements'] = timeFresh('getRequirements', [(g,) for g, _ in pick()])
+    results['fetchStockpiles'] = timeFresh('fetchStockpiles', [(g,) for g, _ in pick()])
+    quota_strings = [', '.join(f'{item[1]}:{rng.randint(10, 200)}' for item in rng.sample(items, 10)) for _ in range(runs)]
+    results['addQuotas'] = timeFresh('addQuotas', [(g, s, q) for (g, s), q in zip(pick(), quota_strings)])
+    results['applyPreset'] = timeFresh('applyPreset', [(g, s, f'preset-{g}') for g, s in pick()])
+    return results
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Prints each operation's p50 next to the same one in an earlier results file
+def compare(results, baseline):
+    for scale, ops in results['scales'].items():
+        old_ops = baseline.get('scales', {}).get(scale)
+        if old_ops is None:
+            continue
+        for op, stats in ops['ops'].items():
+            old = old_ops['ops'].get(op)
+            if old is None or not old['p50_ms']:
+                continue
+            change = (stats['p50_ms'] / old['p50_ms'] - 1) * 100
+            print(f'{scale: <8} {op: <16} p50 {old["p50_ms"]:.3f} -> {stats["p50_ms"]:.3f} ms ({change:+.1f}%)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time DbHandler operations on synthetic databases at several scales')
+    parser.add_argument('--scales', default='small,medium', help=f'comma separated, from {", ".join(SCALES)}')
+    parser.add_argument('--runs', type=int, default=200, help='calls timed per operation and scale')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--keep', help='build the databases in this directory and keep them')
+    args = parser.parse_args()
+
+    scales = args.scales.split(',')
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        parser.error(f'unknown scale {", ".join(unknown)}')
+
+    results = {
+        'commit': gitCommit(),
+        'recorded_at': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'runs': args.runs,
+        'scales': {},
+    }
+    workdir = args.keep or tempfile.mkdtemp(prefix='foxhole-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        for scale in scales:
+            guilds, per_guild = SCALES[scale]
+            db_path = os.path.join(workdir, f'{scale}.db')
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            start = time.perf_counter()
+            items, layout = buildDatabase(db_path, guilds, per_guild, args.seed)
+            build_seconds = time.perf_counter() - start
+            ops = runScale(db_path, items, layout, args.runs, args.seed)
+            results['scales'][scale] = {
+                'guilds': guilds,
+                'stockpiles': guilds * per_guild,
+                'build_seconds': round(build_seconds, 2),
+                'ops': ops,
+            }
+            print(f'{scale}: {guilds} guilds, {guilds * per_guild} stockpiles, built in {build_seconds:.1f}s')
+            for op, stats in ops.items():
+                print(f'  {op: <16} mean {stats["mean_ms"]:8.3f} ms  p50 {stats["p50_ms"]:8.3f} ms  p95 {stats["p95_ms"]:8.3f} ms')
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
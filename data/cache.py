@@ -0,0 +1,132 @@
+import threading
+
+class RequirementsCache():
+    """Per-guild requirements, kept per stockpile and stamped with a logical clock.
+
+    Writers touch the stockpiles they changed once their transaction commits.
+    A cached stockpile entry is reused until a touch newer than its stamp arrives.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._stock_versions = {}
+        self._guild_versions = {}
+        self._guilds = {}
+
+    # Returns the current clock, taken before reading so later writes win
+    def now(self):
+        with self._lock:
+            return self._clock
+
+    # Marks stockpiles whose inventory or quotas changed
+    def touch(self, stock_ids):
+        with self._lock:
+            self._clock += 1
+            for stock_id in stock_ids:
+                self._stock_versions[stock_id] = self._clock
+
+    # Drops a guild's cached view, used when stockpiles are created or deleted
+    def invalidateGuild(self, guild_id):
+        with self._lock:
+            self._clock += 1
+            self._guild_versions[guild_id] = self._clock
+            self._guilds.pop(guild_id, None)
+
+    # Returns (entries, dirty stock ids) or None when the guild has no usable view
+    def lookup(self, guild_id):
+        with self._lock:
+            view = self._guilds.get(guild_id)
+            if view is None:
+                return None
+            stamp, entries = view
+            if self._guild_versions.get(guild_id, 0) > stamp:
+                return None
+            dirty = [
+                stock_id for stock_id, (entry_stamp, _) in entries.items()
+                if self._stock_versions.get(stock_id, 0) > entry_stamp
+            ]
+            return {stock_id: entry for stock_id, (_, entry) in entries.items()}, dirty
+
+    # Stores freshly computed entries read at clock value `stamp`
+    # removed are stock ids the fresh read no longer returned, they leave the view instead of staying dirty
+    def store(self, guild_id, stamp, entries, replace=False, removed=()):
+        with self._lock:
+            if self._guild_versions.get(guild_id, 0) > stamp:
+                return
+            view = self._guilds.get(guild_id)
+            if replace or view is None:
+                view = (stamp, {})
+                self._guilds[guild_id] = view
+            for stock_id, entry in entries.items():
+                view[1][stock_id] = (stamp, entry)
+            for stock_id in removed:
+                view[1].pop(stock_id, None)
+
+
+class GuildCache():
+    """Per-guild values that are loaded on demand and dropped when the guild's data changes.
+
+    Loaders read version() before querying and pass it to store(), so a value read
+    before a concurrent invalidation is never cached.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._versions = {}
+        self._values = {}
+
+    def get(self, guild_id):
+        with self._lock:
+            return self._values.get(guild_id)
+
+    def version(self, guild_id):
+        with self._lock:
+            return (self._epoch, self._versions.get(guild_id, 0))
+
+    def store(self, guild_id, version, value):
+        with self._lock:
+            if (self._epoch, self._versions.get(guild_id, 0)) == version:
+                self._values[guild_id] = value
+
+    def invalidate(self, guild_id):
+        with self._lock:
+            self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+            self._values.pop(guild_id, None)
+
+    # Drops every guild's value, used when shared data such as the map changes
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._values.clear()
+
+
+class Caches():
+    """In-memory state shared by every DbHandler that talks to the same database."""
+    def __init__(self):
+        self.requirements = RequirementsCache()
+        # Ids of registered guilds, guilds are never removed so only positive answers are kept
+        self.guilds = set()
+        # Sorted preset names and stockpile listings per guild
+        self.presets = GuildCache()
+        # Stockpile directory per guild, {id: stockpile} loaded with one join
+        self.stockpiles = GuildCache()
+        # Spatial index over each guild's stockpile towns
+        self.stockpile_index = GuildCache()
+        # CatalogIndex over the items table and the BillOfMaterials parsed from it, static between catalog loads
+        self.catalog = None
+        self.bom = None
+        # Prefix tries and the town -> structure types map, static between map loads
+        self.items = None
+        self.towns = None
+        self.structure_types = None
+        self.town_structures = None
+        # town name -> (region, x, y)
+        self.town_coords = None
+        # static_version stamp the indexes above were built at, see data.snapshot
+        self.static_stamp = None
+        # RouteGraph over the routes table, replaced whole whenever a route changes
+        self.routes = None
+        # Rendered command pages per guild, dropped whenever a write to the guild commits
+        self.pages = GuildCache()
+        # guild id -> TaskQueue of open tasks, only used by the writer
+        self.tasks = {}
@@ -0,0 +1,131 @@
+import bisect
+from collections import Counter, namedtuple
+from types import MappingProxyType
+
+Item = namedtuple('Item', [
+    'id', 'code_name', 'display_name', 'category', 'per_crate', 'factory_queue',
+    'mpf_queue', 'shippable_type', 'ingredients'
+])
+
+ITEM_COLUMNS = ', '.join(Item._fields)
+
+# Similarity below which a trigram match is not offered as a suggestion
+MIN_SIMILARITY = 0.25
+
+def normalize(name):
+    return ' '.join(name.casefold().split())
+
+def trigrams(name):
+    padded = f'  {normalize(name)} '
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+class CatalogIndex():
+    """Immutable in-process view of the items table.
+
+    Maps code names and display names to item ids in O(1), keeps the static
+    item columns, and holds a trigram index plus a sorted name list for
+    ranked "did you mean" suggestions and prefix completion.
+    """
+    __slots__ = ('items', 'by_code', 'by_name', '_names', '_name_ids', '_trigrams', '_trigram_counts')
+
+    def __init__(self, items):
+        by_id = {}
+        by_code = {}
+        by_name = {}
+        postings = {}
+        for item in items:
+            by_id[item.id] = item
+            by_code[item.code_name] = item.id
+            key = normalize(item.display_name)
+            if key in by_name:
+                continue
+            by_name[key] = item.id
+            grams = trigrams(item.display_name)
+            for gram in grams:
+                postings.setdefault(gram, []).append(item.id)
+
+        names = sorted(by_name.items())
+        object.__setattr__(self, 'items', MappingProxyType(by_id))
+        object.__setattr__(self, 'by_code', MappingProxyType(by_code))
+        object.__setattr__(self, 'by_name', MappingProxyType(by_name))
+        object.__setattr__(self, '_names', tuple(n for n, _ in names))
+        object.__setattr__(self, '_name_ids', tuple(i for _, i in names))
+        object.__setattr__(self, '_trigrams', MappingProxyType({g: tuple(ids) for g, ids in postings.items()}))
+        object.__setattr__(self, '_trigram_counts', MappingProxyType(
+            {item_id: len(trigrams(by_id[item_id].display_name)) for item_id in by_name.values()}
+        ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CatalogIndex is immutable')
+
+    # Pickles the finished index so a snapshot restores it without rebuilding the trigrams
+    # Mapping proxies cannot be pickled, they are stored as plain dicts and wrapped again on load
+    def __reduce__(self):
+        return (_restoreCatalog, tuple(
+            dict(value) if isinstance(value, MappingProxyType) else value
+            for value in (getattr(self, name) for name in self.__slots__)
+        ))
+
+    # Builds the index from the items table
+    @classmethod
+    def load(cls, cur):
+        cur.execute(f"SELECT {ITEM_COLUMNS} FROM items ORDER BY id")
+        return cls(Item(*r) for r in cur.fetchall())
+
+    def __len__(self):
+        return len(self.items)
+
+    # Returns the item id for a display name (case and whitespace insensitive), or None
+    def idForName(self, display_name):
+        return self.by_name.get(normalize(display_name))
+
+    # Returns item ids whose display name starts with prefix, in name order
+    def prefixed(self, prefix, limit=25):
+        prefix = normalize(prefix)
+        start = bisect.bisect_left(self._names, prefix)
+        ids = []
+        for i in range(start, len(self._names)):
+            if len(ids) >= limit or not self._names[i].startswith(prefix):
+                break
+            ids.append(self._name_ids[i])
+        return ids
+
+    # Returns display names similar to name, best match first
+    # Prefix matches rank above trigram matches, which are ranked by Jaccard similarity
+    def suggest(self, name, limit=3):
+        grams = trigrams(name)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._trigrams.get(gram, ()))
+        scored = []
+        for item_id, common in shared.items():
+            score = common / (len(grams) + self._trigram_counts[item_id] - common)
+            if score >= MIN_SIMILARITY:
+                scored.append((score, item_id))
+        scored.sort(key=lambda s: (-s[0], self.items[s[1]].display_name))
+
+        ranked = self.prefixed(name, limit)
+        for _, item_id in scored:
+            if len(ranked) >= limit:
+                break
+            if item_id not in ranked:
+                ranked.append(item_id)
+        return [self.items[item_id].display_name for item_id in ranked[:limit]]
+
+    # Returns the item id for a display name, raising ValueError with suggestions on a miss
+    def resolve(self, display_name):
+        item_id = self.idForName(display_name)
+        if item_id is not None:
+            return item_id
+        similar = self.suggest(display_name)
+        if similar:
+            raise ValueError(f"Item {display_name} not found, did you mean {' or '.join(similar)}?")
+        raise ValueError(f"Item {display_name} not found")
+
+
+def _restoreCatalog(*values):
+    index = object.__new__(CatalogIndex)
+    for name, value in zip(CatalogIndex.__slots__, values):
+        object.__setattr__(index, name, MappingProxyType(value) if isinstance(value, dict) else value)
+    return index
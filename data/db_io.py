@@ -1,24 +1,257 @@
 import sqlite3
 import asyncio
+import time
 import csv
+import math
+from collections import Counter
+from contextlib import contextmanager
+from types import MappingProxyType
+
+from data import metrics
+from data.cache import Caches
+from data.snapshot import SNAPSHOT_KEYS, loadStatic, buildStatic, buildMap, saveStatic, staticStamp
+from data.spatial import RegionIndex
+from data.routes import RouteGraph, estimateLength, INF
+from data.tasks import TaskQueue, taskPriority
+from data.loads import VEHICLES, Lot, planTrips
+from data.world_sync import getMajorLabels, assignStructures, matchStructures
 
 TSV_HEADER = 'Stockpile Title	Stockpile Name	Structure Type	Quantity	Name	Crated?	Per Crate	Total	Description	CodeName'
 
+# Parses a FIR TSV export into {(stockpile_name, structure_type): {code_name: [display_name, crates, non_crates]}}
+# Crated and loose rows for the same item are merged into one entry
+def parseTsvByStockpile(tsv_file):
+    reader = csv.reader(tsv_file, delimiter='\t')
+    header = next(reader, None)
+    if header != TSV_HEADER.split('\t'):
+        raise ValueError("Invalid TSV file, headers do not match")
+    groups = {}
+    for r in reader:
+        if not r:
+            continue
+        if len(r) != len(header) or r[5] not in ('true', 'false'):
+            raise ValueError(f"Invalid TSV row on line {reader.line_num}")
+        try:
+            quantity = int(r[3])
+        except ValueError:
+            raise ValueError(f"Invalid TSV row on line {reader.line_num}")
+        items = groups.setdefault((r[1], r[2]), {})
+        entry = items.setdefault(r[9], [r[4], 0, 0])
+        entry[1 if r[5] == 'true' else 2] += quantity
+    return groups
+
+# Returns the items of a TSV export meant for a single stockpile as {code_name: [display_name, crates, non_crates]}
+# Exports holding several stockpiles are rejected rather than merged into one
+def singleStockpile(groups):
+    if len(groups) > 1:
+        raise ValueError("The TSV file holds several stockpiles, leave stock_id empty to update each of them by name")
+    return mergeStockpiles(groups)
+
+# Merges parseTsvByStockpile groups into one {code_name: [display_name, crates, non_crates]}
+def mergeStockpiles(groups):
+    items = {}
+    for group in groups.values():
+        for code_name, (display_name, crates, non_crates) in group.items():
+            entry = items.setdefault(code_name, [display_name, 0, 0])
+            entry[1] += crates
+            entry[2] += non_crates
+    return items
+
+# Parses a quota string of the form "display_name:quantity, display_name:quantity, ..."
+def parseQuotas(quota_data):
+    quotas = {}
+    for q in quota_data.split(','):
+        if not q.strip():
+            continue
+        name, sep, quantity = q.rpartition(':')
+        try:
+            quantity = int(quantity)
+        except ValueError:
+            sep = ''
+        if not sep or not name.strip():
+            raise ValueError(f"Invalid quota '{q.strip()}', expected display_name:quantity")
+        quotas[name.strip()] = quantity
+    if not quotas:
+        raise ValueError("No quotas given")
+    return quotas
+
+# Largest number of ids bound into a single IN (...) clause
+MAX_IN_PARAMS = 500
+
+# Inventory history older than ROLLUP_AGE seconds is merged into one row per HISTORY_BUCKET seconds
+HISTORY_BUCKET = 6 * 3600
+ROLLUP_AGE = 24 * 3600
+# Burn rates are averaged over the last FORECAST_WINDOW seconds, and not trusted below MIN_FORECAST_SPAN of history
+FORECAST_WINDOW = 3 * 24 * 3600
+MIN_FORECAST_SPAN = 3600
+
 class DbHandler():
-    def __init__(self, db_file):
+    def __init__(self, db_file, caches=None):
+        self.db_file = db_file
         self.conn = sqlite3.connect(db_file)
         self.cur = self.conn.cursor()
+        # Per-connection tuning, WAL itself is switched on by the migrations
+        self.cur.execute("PRAGMA busy_timeout = 5000")
+        self.cur.execute("PRAGMA synchronous = NORMAL")
+        self.cur.execute("PRAGMA cache_size = -16000")
+        self.cur.execute("PRAGMA temp_store = MEMORY")
+        self.caches = caches if caches is not None else Caches()
+        if self.caches.catalog is None:
+            self._loadStatic()
+        self.catalog = self.caches.catalog
+        self._touched_stocks = set()
+        self._touched_guilds = set()
+        self._touched_presets = set()
+        # Stockpiles whose tasks are rescored before the next commit
+        self._task_stocks = set()
+        # Routes written since the last commit as {(town, town): length or None}
+        self._touched_routes = {}
+        self._map_changed = False
+        # static_version stamps before and after the map writes of the running transaction
+        self._map_stamps = None
+        # Set while runBatch is applying a batch, _commit then leaves the commit to the batch
+        self._batching = False
+        if metrics.enabled:
+            metrics.instrument(self)
+
+    # Loads the catalog index, the autocomplete tries and the map lookups, from the snapshot when it is current
+    def _loadStatic(self):
+        stamp = staticStamp(self.cur)
+        static = loadStatic(self.cur, self.db_file)
+        self.caches.static_stamp = stamp
+        self._applyStatic(static)
+        self._loadRoutes()
+        self.caches.catalog = static['catalog']
+
+    # Rebuilds the town and structure lookups, rerun whenever the map data changes
+    # The snapshot is rewritten when the map tables really changed, so the next start still skips the rebuild
+    # The in-memory catalog only goes into it when this handler's own map write is all that moved the stamp,
+    # after a write from elsewhere (a catalog upgrade) the snapshot is rebuilt from the tables instead
+    def _loadMap(self):
+        stamp = staticStamp(self.cur)
+        self._applyStatic(buildMap(self.cur))
+        self._loadRoutes()
+        if stamp is None or stamp == self.caches.static_stamp:
+            return
+        if self._map_stamps == (self.caches.static_stamp, stamp):
+            self.caches.static_stamp = stamp
+            saveStatic(self.db_file, stamp, {name: getattr(self.caches, name) for name in SNAPSHOT_KEYS})
+        else:
+            saveStatic(self.db_file, stamp, buildStatic(self.cur))
+
+    def _applyStatic(self, static):
+        for name in SNAPSHOT_KEYS:
+            if name in static:
+                setattr(self.caches, name, static[name])
+
+    def _loadRoutes(self):
+        self.cur.execute("""
+            SELECT a.name, b.name, r.est_length
+            FROM routes r
+            JOIN towns a ON a.id = r.from_id
+            JOIN towns b ON b.id = r.to_id
+            """
+        )
+        self.caches.routes = RouteGraph(self.cur.fetchall())
+
+    # Commits and then publishes which stockpiles and guilds changed to the caches
+    # Tasks of touched stockpiles are rescored first, so they commit together with the change
+    # Inside a batch both are left to runBatch, so readers only ever see committed writes
+    def _commit(self):
+        if self._task_stocks:
+            self._refreshTasks(self._task_stocks)
+            self._task_stocks = set()
+        if self._batching:
+            return
+        self.conn.commit()
+        self._invalidateTouched()
+        self._resetTouched()
+
+    def _invalidateTouched(self):
+        if self._touched_stocks:
+            self.caches.requirements.touch(self._touched_stocks)
+        for guild_id in self._touched_guilds:
+            self.caches.requirements.invalidateGuild(guild_id)
+            self.caches.stockpiles.invalidate(guild_id)
+            self.caches.stockpile_index.invalidate(guild_id)
+        for guild_id in self._touched_presets:
+            self.caches.presets.invalidate(guild_id)
+        if self._map_changed:
+            self._loadMap()
+            self.caches.stockpiles.clear()
+            self.caches.stockpile_index.clear()
+        if self._touched_routes:
+            self.caches.routes = self._routeGraph()
+
+    def _resetTouched(self):
+        self._touched_stocks = set()
+        self._touched_guilds = set()
+        self._touched_presets = set()
+        self._task_stocks = set()
+        self._touched_routes = {}
+        self._map_changed = False
+        self._map_stamps = None
+
+    # Marks stockpiles whose inventory or quotas changed
+    def _touchStocks(self, stock_ids):
+        self._touched_stocks.update(stock_ids)
+        self._task_stocks.update(stock_ids)
+
+    # Runs a block inside a savepoint, if it raises only the block's own writes are undone
+    # Touched caches are left marked, invalidating them again is harmless
+    @contextmanager
+    def _savepoint(self):
+        self.cur.execute("SAVEPOINT op")
+        try:
+            yield
+        except BaseException:
+            self.cur.execute("ROLLBACK TO op")
+            self.cur.execute("RELEASE op")
+            raise
+        self.cur.execute("RELEASE op")
+
+    # Applies a batch of write calls [(method, args)] in a single transaction
+    # Every call runs in its own savepoint so a failing call only undoes its own writes
+    # Returns [(ok, result or exception)] per call once the batch is committed, raises if the commit fails
+    def runBatch(self, calls):
+        results = []
+        self._batching = True
+        try:
+            if not self.conn.in_transaction:
+                self.cur.execute("BEGIN IMMEDIATE")
+            for method, args in calls:
+                try:
+                    with self._savepoint():
+                        results.append((True, getattr(self, method)(*args)))
+                except Exception as e:
+                    results.append((False, e))
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            # Routes and task queues are updated in place rather than invalidated, reload them from what was committed
+            self._map_changed = True
+            self.caches.tasks.clear()
+            raise
+        finally:
+            self._batching = False
+            self._invalidateTouched()
+            self._resetTouched()
+        return results
 
     # Checks if a guild is registered with the bot
+    # Guilds are never unregistered, so a positive answer is cached for good
     def checkRegistration(self, guild_id):
+        if guild_id in self.caches.guilds:
+            return
         self.cur.execute("SELECT 1 FROM guilds WHERE id = ?", (guild_id,))
         if not self.cur.fetchone():
             raise ValueError("Server not registered with this bot")
+        if not self._batching:
+            self.caches.guilds.add(guild_id)
     
-    # Checks if a stockpile exists for this id
-    def checkStockId(self, stock_id):
-        self.cur.execute("SELECT 1 FROM stockpiles WHERE id = ?", (stock_id,))
-        if not self.cur.fetchone():
+    # Checks if a stockpile exists for this id and belongs to the guild
+    def checkStockId(self, guild_id, stock_id):
+        if stock_id not in self.stockpileDirectory(guild_id):
             raise ValueError("Stockpile not found")
 
     # Adds a new guild (discord server)
@@ -29,34 +262,83 @@ class DbHandler():
             raise ValueError(f"Guild {name} is already registered.")
         # Insert the new guild
         self.cur.execute("INSERT INTO guilds (id, name) VALUES (?, ?)", (guild_id, name))
-        self.conn.commit()
+        self._commit()
+
+    # Returns the guild's stockpiles as {id: {'id', 'name', 'town', 'type', 'structure_id'}} in id order
+    # Loaded with one join and cached until a stockpile is created or deleted
+    def stockpileDirectory(self, guild_id):
+        cache = self.caches.stockpiles
+        # Mid-batch the shared entry does not show the batch's own uncommitted writes yet
+        uncommitted = self._batching and guild_id in self._touched_guilds
+        directory = None if uncommitted else cache.get(guild_id)
+        if directory is None:
+            version = cache.version(guild_id)
+            self.cur.execute("""
+                SELECT s.id, s.name, t.name, st.type, s.structure_id
+                FROM stockpiles s
+                JOIN structures st ON st.id = s.structure_id
+                JOIN towns t ON t.id = st.town_id
+                WHERE s.guild_id = ?
+                ORDER BY s.id
+                """, (guild_id,)
+            )
+            directory = MappingProxyType({
+                r[0]: MappingProxyType({'id': r[0], 'name': r[1], 'town': r[2], 'type': r[3], 'structure_id': r[4]})
+                for r in self.cur.fetchall()
+            })
+            if not uncommitted:
+                cache.store(guild_id, version, directory)
+        return directory
 
     # Fetches all stockpiles for a guild
     def fetchStockpiles(self, guild_id):
         self.checkRegistration(guild_id)
-        self.cur.execute("""
-            SELECT id, name, structure_id FROM stockpiles WHERE guild_id = ?
-            """, (guild_id,)
-        )
-        res = self.cur.fetchall()
-        
-        if not res:
+        stockpiles = self.listStockpiles(guild_id)
+        if not stockpiles:
             raise ValueError("No stockpiles exist")
-        
-        stockpiles = []
-        for r in res:
-            self.cur.execute("SELECT type, town_id FROM structures WHERE id = ?", (r[2],))
-            struct_type, struct_id = self.cur.fetchone()
-            self.cur.execute("SELECT name FROM towns WHERE id = ?", (struct_id,))
-            town = self.cur.fetchone()[0]
-            stockpiles.append({
-                'id': r[0],
-                'name': r[1],
-                'town': town,
-                'type': struct_type
-            })
-        return stockpiles
+        return [dict(stock) for stock in stockpiles]
     
+    # Lists a guild's stockpiles, served from the stockpile directory
+    def listStockpiles(self, guild_id):
+        return tuple(self.stockpileDirectory(guild_id).values())
+
+    # Finds the guild's stockpiles closest to a town, nearest first
+    # Map coordinates are per hex, so only stockpiles in the town's region are considered
+    def nearestStockpiles(self, guild_id, town, limit=5):
+        self.checkRegistration(guild_id)
+        coords = self.caches.town_coords.get(town)
+        if coords is None:
+            raise ValueError(f"Town '{town}' not found")
+        region, x, y = coords
+
+        cache = self.caches.stockpile_index
+        index = cache.get(guild_id)
+        if index is None:
+            version = cache.version(guild_id)
+            points = []
+            for stock in self.listStockpiles(guild_id):
+                stock_coords = self.caches.town_coords.get(stock['town'])
+                if stock_coords is not None:
+                    points.append((*stock_coords, stock))
+            index = RegionIndex(points)
+            cache.store(guild_id, version, index)
+
+        nearest = index.nearest(region, x, y, limit)
+        if not nearest:
+            raise ValueError(f"No stockpiles found in {region}")
+        return [{**stock, 'distance': dist} for dist, stock in nearest]
+
+    # Lists a guild's preset names for autocomplete, cached until one is created or deleted
+    def listPresets(self, guild_id):
+        cache = self.caches.presets
+        presets = cache.get(guild_id)
+        if presets is None:
+            version = cache.version(guild_id)
+            self.cur.execute("SELECT name FROM presets WHERE guild_id = ? ORDER BY name", (guild_id,))
+            presets = tuple(r[0] for r in self.cur.fetchall())
+            cache.store(guild_id, version, presets)
+        return presets
+
     # Creates a new stockpile
     def create(self, guild_id, town, type, name):
         self.checkRegistration(guild_id)
@@ -81,12 +363,8 @@ class DbHandler():
             structure_id = structure_id[0]
         
         # Check for duplicate stockpile
-        self.cur.execute("""
-            SELECT 1 FROM stockpiles
-            WHERE guild_id = ? AND structure_id = ? AND name = ?
-            """, (guild_id, structure_id, name)
-        )
-        if self.cur.fetchone():
+        directory = self.stockpileDirectory(guild_id)
+        if any(s['structure_id'] == structure_id and s['name'] == name for s in directory.values()):
             raise ValueError(f"Stockpile {name} already exists in {town}")
         
         # Insert new stockpile
@@ -95,121 +373,175 @@ class DbHandler():
             VALUES (?, ?, ?)
             """, (name, guild_id, structure_id)
         )
-        self.conn.commit()
+        self._touched_guilds.add(guild_id)
+        self._commit()
 
-    # Deletes a stockpile and it's related inventory and quotas
+    # Deletes a stockpile and it's related inventory, history, tasks and quotas
     def delete(self, guild_id, stock_id):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
+        self.checkStockId(guild_id, stock_id)
         
-        # Delete related inventory and quotas, then stockpile
+        # Delete related inventory, history, tasks and quotas, then stockpile
         self.cur.execute("DELETE FROM inventory WHERE stock_id = ?", (stock_id,))
+        self.cur.execute("DELETE FROM inventory_history WHERE stock_id = ?", (stock_id,))
+        self.cur.execute("DELETE FROM tasks WHERE stock_id = ?", (stock_id,))
         self.cur.execute("DELETE FROM quotas WHERE stock_id = ?", (stock_id,))
         self.cur.execute("DELETE FROM stockpiles WHERE id = ?", (stock_id,))
-        self.conn.commit()
+        self._touched_guilds.add(guild_id)
+        self._commit()
 
     # Updates inventories
+    # Returns counts of inventory rows inserted, changed, unchanged and zeroed out
     def updateInventory(self, guild_id, stock_id, tsv_file):
+        return self.ingestInventory(guild_id, stock_id, singleStockpile(parseTsvByStockpile(tsv_file)))
+
+    # Same as updateInventory for items already parsed with singleStockpile
+    def ingestInventory(self, guild_id, stock_id, items):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
-        
-        # Read TSV file
-        reader = csv.reader(tsv_file, delimiter='\t')
-        header = next(reader)
-        if header != TSV_HEADER.split('\t'):
-            raise ValueError("Invalid TSV file, headers do not match")
-        # Save code_name, name, quantity, crated
-        data = [
-            {
-                'code_name': r[9], 
-                'display_name': r[4], 
-                'crated': int(r[3]) if r[5] == 'true' else 0, 
-                'non_crated': int(r[3]) if r[5] == 'false' else 0
-            } 
-            for r in reader
-        ]
-        
-        # Get item_id for each item
-        for d in data:
-            self.cur.execute("""
-                SELECT id FROM items WHERE code_name = ?
-                """, (d['code_name'],)
-            )
-            item_id = self.cur.fetchone()
-            if not item_id:
-                raise ValueError(f"Item {d['display_name']} not found")
+        self.checkStockId(guild_id, stock_id)
+        stats = self._applyInventory(stock_id, items)
+        self._commit()
+        return stats
+
+    # Updates every stockpile found in a multi-stockpile TSV export in one transaction
+    # Rows are routed by their Stockpile Name and Structure Type columns
+    def updateInventories(self, guild_id, tsv_file):
+        return self.ingestInventories(guild_id, parseTsvByStockpile(tsv_file))
+
+    # Same as updateInventories for groups already parsed with parseTsvByStockpile
+    def ingestInventories(self, guild_id, groups):
+        self.checkRegistration(guild_id)
+        stockpiles = {}
+        for stock in self.stockpileDirectory(guild_id).values():
+            stockpiles.setdefault((stock['name'].casefold(), stock['type'].casefold()), []).append(stock['id'])
+
+        matched = []
+        unmatched = []
+        for (name, struct_type), items in groups.items():
+            stock_ids = stockpiles.get((name.casefold(), struct_type.casefold()), [])
+            if len(stock_ids) > 1:
+                raise ValueError(f"Stockpile {name} ({struct_type}) matches several stockpiles, update them by ID")
+            if stock_ids:
+                matched.append((stock_ids[0], name, struct_type, items))
             else:
-                d['item_id'] = item_id[0]
+                unmatched.append({'name': name, 'type': struct_type})
+        if not matched:
+            raise ValueError("No stockpiles in the TSV file match this server's stockpiles")
 
-        # Update inventory, overwrite existing values
-        for d in data:
-            self.cur.execute("""
-                INSERT INTO inventory (item_id, stock_id, crates, non_crates)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT (item_id, stock_id)
-                DO UPDATE SET crates = ?, non_crates = ?
-                """, (d['item_id'], stock_id, d['crated'], d['non_crated'], d['crated'], d['non_crated'])
-            )
-        self.conn.commit()
+        updated = []
+        with self._savepoint():
+            for stock_id, name, struct_type, items in matched:
+                stats = self._applyInventory(stock_id, items)
+                updated.append({'stock_id': stock_id, 'name': name, 'type': struct_type, **stats})
+        self._commit()
+        return {'updated': updated, 'unmatched': unmatched}
+
+    # Writes parsed TSV items to a stockpile, only touching rows whose counts changed
+    # Items missing from the upload are set to zero, nothing is committed here
+    # Every changed row also appends its difference to inventory_history
+    def _applyInventory(self, stock_id, items):
+        item_ids = self.catalog.by_code
+        missing = [display_name for code_name, (display_name, _, _) in items.items() if code_name not in item_ids]
+        if missing:
+            raise ValueError(f"Item {', '.join(missing)} not found")
+
+        self.cur.execute(
+            "SELECT item_id, crates, non_crates FROM inventory WHERE stock_id = ?",
+            (stock_id,)
+        )
+        current = {r[0]: (r[1], r[2]) for r in self.cur.fetchall()}
+
+        inserts = []
+        updates = []
+        # Differences to the previous upload as (stock_id, item_id, recorded_at, crates, non_crates, consumed)
+        history = []
+        recorded_at = int(time.time())
+        unchanged = 0
+        for code_name, (_, crates, non_crates) in items.items():
+            item_id = item_ids[code_name]
+            old = current.pop(item_id, None)
+            if old is None:
+                inserts.append((item_id, stock_id, crates, non_crates))
+                history.append((stock_id, item_id, recorded_at, crates, non_crates, 0))
+            elif old != (crates, non_crates):
+                updates.append((crates, non_crates, item_id, stock_id))
+                history.append((stock_id, item_id, recorded_at, crates - old[0], non_crates - old[1], max(old[0] - crates, 0)))
+            else:
+                unchanged += 1
+        changed = len(updates)
+        zeroed = 0
+        for item_id, (crates, non_crates) in current.items():
+            if (crates, non_crates) != (0, 0):
+                updates.append((0, 0, item_id, stock_id))
+                history.append((stock_id, item_id, recorded_at, -crates, -non_crates, crates))
+                zeroed += 1
+
+        self.cur.executemany("""
+            INSERT INTO inventory (item_id, stock_id, crates, non_crates)
+            VALUES (?, ?, ?, ?)
+            """, inserts
+        )
+        self.cur.executemany("""
+            UPDATE inventory SET crates = ?, non_crates = ?
+            WHERE item_id = ? AND stock_id = ?
+            """, updates
+        )
+        # Uploads within the same second add up
+        self.cur.executemany("""
+            INSERT INTO inventory_history (stock_id, item_id, recorded_at, crates, non_crates, consumed)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (stock_id, item_id, recorded_at) DO UPDATE SET
+                crates = crates + excluded.crates,
+                non_crates = non_crates + excluded.non_crates,
+                consumed = consumed + excluded.consumed
+            """, history
+        )
+        if inserts or updates:
+            self._touchStocks((stock_id,))
+        return {
+            'inserted': len(inserts),
+            'changed': changed,
+            'unchanged': unchanged,
+            'zeroed': zeroed
+        }
+
+    # Resolves a quota string to {item_id: quantity} against the catalog index
+    def _resolveQuotas(self, quota_data):
+        return {self.catalog.resolve(name): quantity for name, quantity in parseQuotas(quota_data).items()}
 
     # Updates quotas
     # quota_data is a string of the form "display_name:quantity, display_name:quantity, ..."
     def addQuotas(self, guild_id, stock_id, quota_data):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
+        self.checkStockId(guild_id, stock_id)
 
-        # Parse quota_data
-        quotas = {}
-        for q in quota_data.split(', '):
-            name, quantity = q.split(':')
-            quotas[name] = int(quantity)
+        quota_ids = self._resolveQuotas(quota_data)
 
-        # Get item_id for each item
-        quota_ids = {}
-        for name, quantity in quotas.items():
-            self.cur.execute("""
-                SELECT id FROM items WHERE display_name = ?
-                """, (name,)
-            )
-            item_id = self.cur.fetchone()
-            if item_id:
-                quota_ids[item_id[0]] = quantity
-            else:
-                # Search for similar names
-                self.cur.execute("""
-                    SELECT display_name FROM items
-                    WHERE display_name LIKE ?
-                    """, (f'%{name}%',))
-                similar_name = self.cur.fetchone()
-                if similar_name:
-                    raise ValueError(f"Item {name} not found, did you mean {similar_name[0]}?")
-                else:
-                    raise ValueError(f"Item {name} not found")
-        
         # Update quotas, overwrite existing values
-        for item_id, quantity in quota_ids.items():
-            self.cur.execute("""
-                INSERT INTO quotas (stock_id, item_id, amount)
-                VALUES (?, ?, ?)
-                ON CONFLICT (stock_id, item_id)
-                DO UPDATE SET amount = ?
-                """, (stock_id, item_id, quantity, quantity)
-            )
-        self.conn.commit()
+        self.cur.executemany("""
+            INSERT INTO quotas (stock_id, item_id, amount)
+            VALUES (?, ?, ?)
+            ON CONFLICT (stock_id, item_id)
+            DO UPDATE SET amount = excluded.amount
+            """, [(stock_id, item_id, quantity) for item_id, quantity in quota_ids.items()]
+        )
+        self._touchStocks((stock_id,))
+        self._commit()
 
 
     # Deletes all quotas set on a stockpile
     def deleteQuotas(self, guild_id, stock_id):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
+        self.checkStockId(guild_id, stock_id)
         self.cur.execute("DELETE FROM quotas WHERE stock_id = ?", (stock_id,))
-        self.conn.commit()
+        self._touchStocks((stock_id,))
+        self._commit()
 
 
     # Fetches the quotas set on a stockpile
     def fetchQuotas(self, guild_id, stock_id):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
+        self.checkStockId(guild_id, stock_id)
         # Get quota data
         self.cur.execute("""
             SELECT i.display_name, q.amount
@@ -224,7 +556,8 @@ class DbHandler():
         
         return [{'display_name': r[0], 'quantity': r[1]} for r in res]
     
-    # Adds a quota preset string to the database
+    # Adds a quota preset to the database
+    # Items are resolved once here and stored as (preset, item_id, amount) rows
     def createPreset(self, guild_id, preset_name, quota_data):
         self.checkRegistration(guild_id)
         # Check if a preset already exists with this name
@@ -233,115 +566,575 @@ class DbHandler():
             raise ValueError(f"Preset named {preset_name} already exists")
 
         # Validate item data in the quota string
-        quotas = {}
-        for q in quota_data.split(', '):
-            name, quantity = q.split(':')
-            quotas[name] = int(quantity)
-        quota_ids = {}
-        for name, quantity in quotas.items():
-            self.cur.execute("""
-                SELECT id FROM items WHERE display_name = ?
-                """, (name,)
-            )
-            item_id = self.cur.fetchone()
-            if item_id:
-                quota_ids[item_id[0]] = quantity
-            else:
-                # Search for similar names
-                self.cur.execute("""
-                    SELECT display_name FROM items
-                    WHERE display_name LIKE ?
-                    """, (f'%{name}%',))
-                similar_name = self.cur.fetchone()
-                if similar_name:
-                    raise ValueError(f"Item {name} not found, did you mean {similar_name[0]}?")
-                else:
-                    raise ValueError(f"Item {name} not found")
+        quota_ids = self._resolveQuotas(quota_data)
+        quota_string = ', '.join(
+            f"{self.catalog.items[item_id].display_name}:{quantity}" for item_id, quantity in quota_ids.items()
+        )
         # Add preset to DB
         self.cur.execute(
             "INSERT INTO presets (name, quota_string, guild_id) VALUES (?,?,?)"
-            , (preset_name, quota_data, guild_id)
+            , (preset_name, quota_string, guild_id)
         )
+        self.cur.executemany(
+            "INSERT INTO preset_items (preset, item_id, amount) VALUES (?,?,?)"
+            , [(preset_name, item_id, quantity) for item_id, quantity in quota_ids.items()]
+        )
+        self._touched_presets.add(guild_id)
+        self._commit()
 
     # Deletes a named preset from the database
     def deletePreset(self, guild_id, preset_name):
         self.checkRegistration(guild_id)
-        # Check if a preset already exists with this name
-        self.cur.execute("SELECT name FROM presets WHERE name = ?", (preset_name,))
+        self.checkPreset(guild_id, preset_name)
+        self.cur.execute("DELETE FROM preset_items WHERE preset = ?", (preset_name,))
+        self.cur.execute("DELETE FROM presets WHERE name = ?", (preset_name,))
+        self._touched_presets.add(guild_id)
+        self._commit()
+
+    # Checks that a preset exists and belongs to this guild
+    def checkPreset(self, guild_id, preset_name):
+        self.cur.execute("SELECT 1 FROM presets WHERE name = ? AND guild_id = ?", (preset_name, guild_id))
         if not self.cur.fetchone():
             raise ValueError(f"No preset named {preset_name} exists")
-        self.cur.execute("DELETE FROM presets WHERE name=?", (preset_name,))
 
-    
     # Adds a preset quota to a stockpile
     def applyPreset(self, guild_id, stock_id, preset_name):
         self.checkRegistration(guild_id)
-        self.checkStockId(stock_id)
-        # Parse quota string and get item ids
-        self.cur.execute(
-            "SELECT quota_string FROM presets WHERE name = ?",
-            (preset_name,)
-        )
-        quota_data = self.cur.fetchone()
-        if not quota_data:
-            raise ValueError(f"No preset named {preset_name} exists")
-        print(quota_data)
-        quotas = {}
-        for q in quota_data[0].split(', '):
-            name, quantity = q.split(':')
-            quotas[name] = int(quantity)
-        quota_ids = {}
-        for name, quantity in quotas.items():
-            self.cur.execute("""
-                SELECT id FROM items WHERE display_name = ?
-                """, (name,)
-            )
-            item_id = self.cur.fetchone()
-            if item_id:
-                quota_ids[item_id[0]] = quantity
-            else:
-                raise ValueError(f"Could not find item {name}")
-            
-        # Update quotas, add to existing values
-        for item_id, quantity in quota_ids.items():
-            self.cur.execute("""
+        self.checkStockId(guild_id, stock_id)
+        self.checkPreset(guild_id, preset_name)
+        self._applyPreset(preset_name, [stock_id])
+
+    # Adds a preset quota to every stockpile of a structure type, returns the number of stockpiles
+    def applyPresetToType(self, guild_id, structure_type, preset_name):
+        self.checkRegistration(guild_id)
+        self.checkPreset(guild_id, preset_name)
+        stock_ids = [s['id'] for s in self.stockpileDirectory(guild_id).values() if s['type'] == structure_type]
+        if not stock_ids:
+            raise ValueError(f"No stockpiles found at a {structure_type}")
+        self._applyPreset(preset_name, stock_ids)
+        return len(stock_ids)
+
+    # Adds a preset's items to the quotas of the given stockpiles, resolved by the caller from the stockpile directory
+    # One INSERT ... SELECT upsert per id batch in one transaction, existing quotas are added to
+    def _applyPreset(self, preset_name, stock_ids):
+        for i in range(0, len(stock_ids), MAX_IN_PARAMS):
+            batch = stock_ids[i:i+MAX_IN_PARAMS]
+            self.cur.execute(f"""
                 INSERT INTO quotas (stock_id, item_id, amount)
-                VALUES (?, ?, ?)
+                SELECT s.id, p.item_id, p.amount
+                FROM stockpiles s
+                JOIN preset_items p ON p.preset = ?
+                WHERE s.id IN ({','.join('?' * len(batch))})
                 ON CONFLICT (stock_id, item_id)
-                DO UPDATE SET amount = amount + ?
-                """, (stock_id, item_id, quantity, quantity)
+                DO UPDATE SET amount = amount + excluded.amount
+                """, (preset_name, *batch)
             )
-
+        self._touchStocks(stock_ids)
+        self._commit()
 
     # Fetches the requirements to meet quotas for all stockpiles
+    # Served from the per-guild cache, only stockpiles changed since the last call are re-queried
     def getRequirements(self, guild_id):
         self.checkRegistration(guild_id)
-        # Get guild's stockpiles
-        self.cur.execute("""
-            SELECT id, name FROM stockpiles WHERE guild_id = ?
-            """, (723282644271366194,)
-        )
-        res = self.cur.fetchall()
-        if not res:
+        cache = self.caches.requirements
+        stamp = cache.now()
+        cached = cache.lookup(guild_id)
+        if cached is None:
+            req_dict = self._queryRequirements(guild_id)
+            cache.store(guild_id, stamp, req_dict, replace=True)
+        else:
+            req_dict, dirty = cached
+            if dirty:
+                fresh = self._queryRequirements(guild_id, dirty)
+                removed = [stock_id for stock_id in dirty if stock_id not in fresh]
+                for stock_id in removed:
+                    req_dict.pop(stock_id, None)
+                req_dict.update(fresh)
+                cache.store(guild_id, stamp, fresh, removed=removed)
+
+        if not req_dict:
             raise ValueError("No stockpiles exist")
-        
+        return dict(sorted(req_dict.items()))
+
+    # Computes requirements for a guild's stockpiles (optionally only stock_ids) in one query per id batch
+    def _queryRequirements(self, guild_id, stock_ids=None):
+        query = """
+            SELECT s.id, s.name, i.display_name, q.amount - COALESCE(inv.crates, 0)
+            FROM stockpiles s
+            LEFT JOIN quotas q ON q.stock_id = s.id
+            LEFT JOIN items i ON i.id = q.item_id
+            LEFT JOIN inventory inv ON inv.stock_id = q.stock_id AND inv.item_id = q.item_id
+            WHERE s.guild_id = ?
+            """
+        if stock_ids is None:
+            batches = [()]
+        else:
+            stock_ids = list(stock_ids)
+            batches = [stock_ids[i:i+MAX_IN_PARAMS] for i in range(0, len(stock_ids), MAX_IN_PARAMS)]
+
         req_dict = {}
-        for stockpile_info in res:
-            stock_id, stock_name = stockpile_info
-            self.cur.execute("""
-                SELECT i.display_name, q.amount, inv.crates
+        for batch in batches:
+            sql = query
+            if batch:
+                sql += " AND s.id IN ({})".format(','.join('?' * len(batch)))
+            self.cur.execute(sql, (guild_id, *batch))
+            for stock_id, stock_name, display_name, quantity in self.cur.fetchall():
+                entry = req_dict.setdefault(stock_id, {
+                    'stock_id': stock_id,
+                    'stock_name': stock_name,
+                    'requirements': {}
+                })
+                if display_name is not None:
+                    entry['requirements'][display_name] = quantity
+        return req_dict
+
+    # Fetches the requirements ordered by road distance from a source town, nearest stockpile first
+    # Stockpiles without a road connection to source come last with an infinite distance
+    def getRequirementsFrom(self, guild_id, source):
+        routes = self.caches.routes
+        if source not in routes:
+            raise ValueError(f"No routes known for {source}")
+        requirements = self.getRequirements(guild_id)
+        directory = self.stockpileDirectory(guild_id)
+        ordered = {}
+        for stock_id, reqs in requirements.items():
+            stock = directory.get(stock_id)
+            ordered[stock_id] = {**reqs, 'distance': routes.distance(source, stock['town']) if stock else INF}
+        return dict(sorted(ordered.items(), key=lambda r: (r[1]['distance'], r[0])))
+
+    # Resolves two town names to ids for a route, stored lowest id first
+    def _routeTowns(self, from_town, to_town):
+        if from_town == to_town:
+            raise ValueError("A route needs two different towns")
+        self.cur.execute("SELECT name, id FROM towns WHERE name IN (?, ?)", (from_town, to_town))
+        town_ids = dict(self.cur.fetchall())
+        for town in (from_town, to_town):
+            if town not in town_ids:
+                raise ValueError(f"Town '{town}' not found")
+        return sorted((town_ids[from_town], town_ids[to_town]))
+
+    # Adds or updates the road between two towns, returns its length
+    # Without a length the road is estimated from the towns' coordinates, which only works within a region
+    def addRoute(self, guild_id, from_town, to_town, length=None):
+        self.checkRegistration(guild_id)
+        from_id, to_id = self._routeTowns(from_town, to_town)
+        if length is None:
+            coords = self.caches.town_coords
+            length = estimateLength(coords.get(from_town), coords.get(to_town))
+            if length is None:
+                raise ValueError(f"Give a length for the route, {from_town} and {to_town} are not in the same region")
+        if length <= 0:
+            raise ValueError("Route length must be positive")
+        self.cur.execute("""
+            INSERT INTO routes (from_id, to_id, est_length) VALUES (?, ?, ?)
+            ON CONFLICT (from_id, to_id) DO UPDATE SET est_length = excluded.est_length
+            """, (from_id, to_id, length)
+        )
+        self._routeChanged(from_town, to_town, length)
+        self._commit()
+        return length
+
+    # Removes the road between two towns
+    def deleteRoute(self, guild_id, from_town, to_town):
+        self.checkRegistration(guild_id)
+        from_id, to_id = self._routeTowns(from_town, to_town)
+        self.cur.execute("DELETE FROM routes WHERE from_id = ? AND to_id = ?", (from_id, to_id))
+        if not self.cur.rowcount:
+            raise ValueError(f"No route between {from_town} and {to_town}")
+        self._routeChanged(from_town, to_town, None)
+        self._commit()
+
+    # Records a written route and marks the open tasks it can rescore, those of every guild with a hub
+    def _routeChanged(self, from_town, to_town, length):
+        self._touched_routes[(from_town, to_town)] = length
+        self.cur.execute("""
+            SELECT DISTINCT t.stock_id
+            FROM tasks t
+            JOIN guilds g ON g.id = t.guild_id
+            WHERE t.status = 'open' AND g.hub IS NOT NULL
+            """
+        )
+        self._task_stocks.update(r[0] for r in self.cur.fetchall())
+
+    # Returns the road graph including routes written since the last commit
+    def _routeGraph(self):
+        routes = self.caches.routes
+        for (a, b), length in self._touched_routes.items():
+            routes = routes.withRoute(a, b, length)
+        return routes
+
+    # Returns a guild's queue of open tasks, loaded on first use
+    # Queues are only used from the writer, every claim goes through one
+    def _taskQueue(self, guild_id):
+        queue = self.caches.tasks.get(guild_id)
+        if queue is None:
+            self.cur.execute("SELECT id, priority FROM tasks WHERE guild_id = ? AND status = 'open'", (guild_id,))
+            queue = TaskQueue(self.cur.fetchall())
+            self.caches.tasks[guild_id] = queue
+        return queue
+
+    # Rescores the tasks of the given stockpiles against their current deficits, inside the running transaction
+    # New deficits get an open task, open tasks whose deficit is gone are dropped and claimed tasks are left to their driver
+    def _refreshTasks(self, stock_ids):
+        stock_ids = list(stock_ids)
+        routes = self._routeGraph()
+        deficits = {}
+        active = {}
+        for i in range(0, len(stock_ids), MAX_IN_PARAMS):
+            batch = stock_ids[i:i+MAX_IN_PARAMS]
+            marks = ','.join('?' * len(batch))
+            self.cur.execute(f"""
+                SELECT s.guild_id, q.stock_id, q.item_id, q.amount, q.amount - COALESCE(inv.crates, 0), g.hub, t.name
                 FROM quotas q
-                JOIN items i ON q.item_id = i.id
-                LEFT JOIN inventory inv ON q.item_id = inv.item_id AND q.stock_id = inv.stock_id
-                WHERE q.stock_id = ?
-                """, (stock_id,)
+                JOIN stockpiles s ON s.id = q.stock_id
+                JOIN guilds g ON g.id = s.guild_id
+                JOIN structures st ON st.id = s.structure_id
+                JOIN towns t ON t.id = st.town_id
+                LEFT JOIN inventory inv ON inv.stock_id = q.stock_id AND inv.item_id = q.item_id
+                WHERE q.stock_id IN ({marks})
+                """, batch
             )
-            reqs = self.cur.fetchall()
-            req_dict[stock_id] = {
-                'stock_id': stock_id,
-                'stock_name': stock_name,
-                'requirements': {quota[0]: quota[1] - quota[2] if quota[2] else quota[1] for quota in reqs}
+            for guild_id, stock_id, item_id, quota, crates, hub, town in self.cur.fetchall():
+                if crates > 0:
+                    distance = routes.distance(hub, town) if hub else 0
+                    deficits[(stock_id, item_id)] = (guild_id, crates, taskPriority(crates, quota, distance))
+            self.cur.execute(f"""
+                SELECT id, guild_id, stock_id, item_id, crates, priority, status
+                FROM tasks
+                WHERE status != 'done' AND stock_id IN ({marks})
+                """, batch
+            )
+            for row in self.cur.fetchall():
+                active[(row[2], row[3])] = row
+
+        queues = self.caches.tasks
+        now = int(time.time())
+        for key, (task_id, guild_id, _, _, crates, priority, status) in active.items():
+            deficit = deficits.pop(key, None)
+            if status != 'open':
+                continue
+            queue = queues.get(guild_id)
+            if deficit is None:
+                self.cur.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+                if queue is not None:
+                    queue.remove(task_id)
+            elif (crates, priority) != deficit[1:]:
+                self.cur.execute("UPDATE tasks SET crates = ?, priority = ? WHERE id = ?", (*deficit[1:], task_id))
+                if queue is not None:
+                    queue.push(task_id, deficit[2])
+        for (stock_id, item_id), (guild_id, crates, priority) in deficits.items():
+            self.cur.execute("""
+                INSERT INTO tasks (guild_id, stock_id, item_id, crates, priority, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """, (guild_id, stock_id, item_id, crates, priority, now)
+            )
+            queue = queues.get(guild_id)
+            if queue is not None:
+                queue.push(self.cur.lastrowid, priority)
+
+    # Fetches tasks matching a condition on the tasks table t, highest priority first
+    def _queryTasks(self, condition, params, limit=None):
+        self.cur.execute(f"""
+            SELECT t.id, t.status, t.claimed_by, t.stock_id, s.name, tn.name, i.display_name, t.crates, t.priority
+            FROM tasks t
+            JOIN stockpiles s ON s.id = t.stock_id
+            JOIN structures st ON st.id = s.structure_id
+            JOIN towns tn ON tn.id = st.town_id
+            JOIN items i ON i.id = t.item_id
+            WHERE {condition}
+            ORDER BY t.status = 'claimed', t.priority DESC, t.id
+            LIMIT ?
+            """, (*params, -1 if limit is None else limit)
+        )
+        return [{
+            'id': r[0],
+            'status': r[1],
+            'claimed_by': r[2],
+            'stock_id': r[3],
+            'stock_name': r[4],
+            'town': r[5],
+            'item': r[6],
+            'crates': r[7],
+            'priority': r[8]
+        } for r in self.cur.fetchall()]
+
+    # Lists a guild's open and claimed tasks, open ones first by priority
+    def fetchTasks(self, guild_id, limit=None):
+        self.checkRegistration(guild_id)
+        return self._queryTasks("t.guild_id = ? AND t.status != 'done'", (guild_id,), limit)
+
+    # Claims the guild's highest priority open task for a user and returns it
+    # The queue pops in O(log n), the conditional update makes sure only one claim can take a task
+    def claimTask(self, guild_id, user_id):
+        self.checkRegistration(guild_id)
+        queue = self._taskQueue(guild_id)
+        while True:
+            task_id = queue.pop()
+            if task_id is None:
+                raise ValueError("No open tasks")
+            self.cur.execute("""
+                UPDATE tasks SET status = 'claimed', claimed_by = ?, claimed_at = ?
+                WHERE id = ? AND status = 'open'
+                """, (user_id, int(time.time()), task_id)
+            )
+            # A task that was dropped or claimed since it was queued leaves nothing to update
+            if self.cur.rowcount:
+                break
+        self._commit()
+        return self._queryTasks("t.id = ?", (task_id,))[0]
+
+    # Marks a task claimed by the user as delivered
+    def completeTask(self, guild_id, user_id, task_id):
+        self.checkRegistration(guild_id)
+        self.cur.execute("""
+            UPDATE tasks SET status = 'done', completed_at = ?
+            WHERE id = ? AND guild_id = ? AND status = 'claimed' AND claimed_by = ?
+            """, (int(time.time()), task_id, guild_id, user_id)
+        )
+        if not self.cur.rowcount:
+            raise ValueError(f"Task {task_id} is not claimed by you")
+        self._commit()
+
+    # Sets the town task distances are measured from and rescores the guild's tasks
+    def setHub(self, guild_id, town):
+        self.checkRegistration(guild_id)
+        self.cur.execute("SELECT 1 FROM towns WHERE name = ?", (town,))
+        if not self.cur.fetchone():
+            raise ValueError(f"Town '{town}' not found")
+        self.cur.execute("UPDATE guilds SET hub = ? WHERE id = ?", (town, guild_id))
+        self._task_stocks.update(self.stockpileDirectory(guild_id))
+        self._commit()
+
+    # Works out what the factories need to build to cover every quota deficit of the guild
+    # Deficits are summed per item in one query, then expanded through the memoized bill of materials
+    # Returns {'queues': [{'building', 'queue', 'items': {display_name: crates}, 'materials': {display_name: quantity}}],
+    # 'unbuildable': {display_name: crates}}, one queue per production queue with raw materials rounded up,
+    # and the deficits of items no recipe in the catalog makes
+    def production(self, guild_id):
+        self.checkRegistration(guild_id)
+        self.cur.execute("""
+            SELECT q.item_id, SUM(MAX(q.amount - COALESCE(inv.crates, 0), 0)) AS deficit
+            FROM quotas q
+            JOIN stockpiles s ON s.id = q.stock_id
+            LEFT JOIN inventory inv ON inv.stock_id = q.stock_id AND inv.item_id = q.item_id
+            WHERE s.guild_id = ?
+            GROUP BY q.item_id
+            HAVING deficit > 0
+            """, (guild_id,)
+        )
+        bom = self.caches.bom
+        queues = {}
+        unbuildable = {}
+        for item_id, crates in self.cur.fetchall():
+            item = self.catalog.items[item_id]
+            if item.code_name not in bom:
+                unbuildable[item.display_name] = crates
+                continue
+            if item.factory_queue:
+                key = ('Factory', item.factory_queue)
+            elif item.mpf_queue:
+                key = ('Mass Production Factory', item.mpf_queue)
+            else:
+                key = ('Other', item.category or '')
+            entry = queues.setdefault(key, {'building': key[0], 'queue': key[1], 'items': {}, 'materials': Counter()})
+            entry['items'][item.display_name] = crates
+            for code_name, quantity in bom.expand(item.code_name).items():
+                entry['materials'][code_name] += quantity * crates
+
+        def displayName(code_name):
+            item_id = self.catalog.by_code.get(code_name)
+            return self.catalog.items[item_id].display_name if item_id is not None else code_name
+
+        plan = []
+        for key in sorted(queues):
+            entry = queues[key]
+            entry['materials'] = {
+                displayName(code_name): math.ceil(quantity)
+                for code_name, quantity in entry['materials'].most_common()
             }
-        
-        return req_dict
+            plan.append(entry)
+        return {'queues': plan, 'unbuildable': dict(sorted(unbuildable.items()))}
 
+    # Packs every quota deficit of the guild into trips of a vehicle class from VEHICLES, grouped by destination town
+    # Only items the vehicle can haul are planned, the crates of the others are reported as skipped
+    # Returns {'vehicle', 'slots', 'trips': [{'town', 'crates', 'loads': [Lot]}], 'skipped'}
+    def planLoads(self, guild_id, vehicle='truck'):
+        self.checkRegistration(guild_id)
+        if vehicle not in VEHICLES:
+            raise ValueError(f"Unknown vehicle {vehicle}, choose from {', '.join(VEHICLES)}")
+        vehicle = VEHICLES[vehicle]
+        self.cur.execute("""
+            SELECT s.id, s.name, t.name, i.display_name, i.per_crate, i.shippable_type,
+                q.amount - COALESCE(inv.crates, 0) AS deficit
+            FROM quotas q
+            JOIN stockpiles s ON s.id = q.stock_id
+            JOIN structures st ON st.id = s.structure_id
+            JOIN towns t ON t.id = st.town_id
+            JOIN items i ON i.id = q.item_id
+            LEFT JOIN inventory inv ON inv.stock_id = q.stock_id AND inv.item_id = q.item_id
+            WHERE s.guild_id = ? AND q.amount - COALESCE(inv.crates, 0) > 0
+            """, (guild_id,)
+        )
+        lots_by_town = {}
+        skipped = 0
+        for stock_id, stock_name, town, item, per_crate, shippable_type, crates in self.cur.fetchall():
+            if bool(shippable_type) != vehicle.shippables:
+                skipped += crates
+                continue
+            units = crates * per_crate if isinstance(per_crate, int) else 0
+            lots_by_town.setdefault(town, []).append(Lot(stock_id, stock_name, item, crates, units))
+        return {
+            'vehicle': vehicle.name,
+            'slots': vehicle.slots,
+            'trips': planTrips(lots_by_town, vehicle.slots),
+            'skipped': skipped
+        }
+
+    # Forecasts when the quota'd items of the guild's stockpiles (or one stockpile) fall below their quota
+    # Burn rates are crates consumed per hour since the start of the forecast window or of the stockpile's history,
+    # whichever is later, and come from a single aggregate over inventory_history
+    # Items that are not being used up are left out
+    # Returns [{'stock_id', 'stock_name', 'item', 'crates', 'quota', 'per_hour', 'hours_left'}], soonest first
+    def forecast(self, guild_id, stock_id=None, limit=None):
+        self.checkRegistration(guild_id)
+        condition = "s.guild_id = :guild_id"
+        if stock_id is not None:
+            self.checkStockId(guild_id, stock_id)
+            condition += " AND s.id = :stock_id"
+        now = int(time.time())
+        start = now - FORECAST_WINDOW
+        self.cur.execute(f"""
+            WITH burn AS (
+                SELECT h.stock_id, h.item_id,
+                    SUM(CASE WHEN h.recorded_at >= :start THEN h.consumed ELSE 0 END) AS consumed,
+                    MIN(MIN(h.recorded_at)) OVER (PARTITION BY h.stock_id) AS since
+                FROM inventory_history h
+                JOIN stockpiles s ON s.id = h.stock_id
+                WHERE {condition}
+                GROUP BY h.stock_id, h.item_id
+            )
+            SELECT b.stock_id, s.name, i.display_name, COALESCE(inv.crates, 0), q.amount, b.consumed, b.since
+            FROM burn b
+            JOIN quotas q ON q.stock_id = b.stock_id AND q.item_id = b.item_id
+            JOIN stockpiles s ON s.id = b.stock_id
+            JOIN items i ON i.id = b.item_id
+            LEFT JOIN inventory inv ON inv.stock_id = b.stock_id AND inv.item_id = b.item_id
+            WHERE b.consumed > 0
+            """, {'guild_id': guild_id, 'stock_id': stock_id, 'start': start}
+        )
+        forecasts = []
+        for stock, stock_name, item, crates, quota, consumed, since in self.cur.fetchall():
+            span = now - max(since, start)
+            if span < MIN_FORECAST_SPAN:
+                continue
+            per_hour = consumed * 3600 / span
+            forecasts.append({
+                'stock_id': stock,
+                'stock_name': stock_name,
+                'item': item,
+                'crates': crates,
+                'quota': quota,
+                'per_hour': per_hour,
+                'hours_left': max(crates - quota, 0) / per_hour
+            })
+        forecasts.sort(key=lambda f: (f['hours_left'], -f['per_hour']))
+        return forecasts[:limit]
+
+    # Merges inventory history older than ROLLUP_AGE into one row per (stockpile, item, HISTORY_BUCKET)
+    # Buckets are keyed by their start time, so rolling up again leaves merged rows alone
+    # Returns the number of rows removed
+    def rollupHistory(self):
+        cutoff = int(time.time()) - ROLLUP_AGE
+        cutoff -= cutoff % HISTORY_BUCKET
+        self.cur.execute("""
+            SELECT stock_id, item_id, recorded_at - recorded_at % :bucket AS bucket,
+                SUM(crates), SUM(non_crates), SUM(consumed), COUNT(*)
+            FROM inventory_history
+            WHERE recorded_at < :cutoff
+            GROUP BY stock_id, item_id, bucket
+            HAVING COUNT(*) > 1 OR MIN(recorded_at) != bucket
+            """, {'bucket': HISTORY_BUCKET, 'cutoff': cutoff}
+        )
+        rows = self.cur.fetchall()
+        self.cur.executemany("""
+            DELETE FROM inventory_history
+            WHERE stock_id = ? AND item_id = ? AND recorded_at >= ? AND recorded_at < ?
+            """, [(r[0], r[1], r[2], r[2] + HISTORY_BUCKET) for r in rows]
+        )
+        self.cur.executemany("""
+            INSERT INTO inventory_history (stock_id, item_id, recorded_at, crates, non_crates, consumed)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, [r[:6] for r in rows]
+        )
+        self._commit()
+        return sum(r[6] for r in rows) - len(rows)
+
+    # Fetches the stored ETags of every hex as {hex: (static_etag, dynamic_etag)}
+    def fetchHexState(self):
+        self.cur.execute("SELECT hex, static_etag, dynamic_etag FROM hex_state")
+        return {r[0]: (r[1], r[2]) for r in self.cur.fetchall()}
+
+    # Applies crawled hexes (see MapCrawler.crawlHex) to towns and structures in one transaction
+    # Towns are upserted by name and structures matched in place, so stockpile foreign keys stay valid
+    def syncHexes(self, results):
+        stats = {'hexes': 0, 'towns': 0, 'inserted': 0, 'updated': 0, 'deleted': 0, 'kept': 0}
+        before = staticStamp(self.cur)
+        for result in results:
+            hexname = result['hex']
+            static_etag, dynamic_etag = result['etags']
+            if result['static'] is not None:
+                labels = getMajorLabels(result['static'])
+                self.cur.executemany("""
+                    INSERT INTO towns (name, region, x, y) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET region = excluded.region, x = excluded.x, y = excluded.y
+                    WHERE region IS NOT excluded.region OR x IS NOT excluded.x OR y IS NOT excluded.y
+                    """, [(name, hexname, x, y) for name, (x, y) in labels.items()]
+                )
+                stats['towns'] += len(labels)
+
+            if result['dynamic'] is not None:
+                self.cur.execute("SELECT id, name, x, y FROM towns WHERE region = ?", (hexname,))
+                towns = self.cur.fetchall()
+                town_ids = {r[1]: r[0] for r in towns}
+                labels = {r[1]: (r[2], r[3]) for r in towns}
+                found = [
+                    (town_ids[name], s['type'], s['x'], s['y'])
+                    for name, structures in assignStructures(labels, result['dynamic']).items()
+                    for s in structures
+                ]
+                self.cur.execute("""
+                    SELECT s.id, s.town_id, s.type, s.x, s.y,
+                        EXISTS (SELECT 1 FROM stockpiles WHERE structure_id = s.id)
+                    FROM structures s
+                    JOIN towns t ON t.id = s.town_id
+                    WHERE t.region = ?
+                    """, (hexname,)
+                )
+                updates, inserts, deletes, kept = matchStructures(self.cur.fetchall(), found)
+                self.cur.executemany("UPDATE structures SET x = ?, y = ? WHERE id = ?", updates)
+                self.cur.executemany("INSERT INTO structures (town_id, type, x, y) VALUES (?, ?, ?, ?)", inserts)
+                self.cur.executemany("DELETE FROM structures WHERE id = ?", [(i,) for i in deletes])
+                stats['inserted'] += len(inserts)
+                stats['updated'] += len(updates)
+                stats['deleted'] += len(deletes)
+                stats['kept'] += len(kept)
+
+            version = (result['dynamic'] or {}).get('version')
+            self.cur.execute("""
+                INSERT INTO hex_state (hex, static_etag, dynamic_etag, version, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (hex) DO UPDATE SET
+                    static_etag = excluded.static_etag,
+                    dynamic_etag = excluded.dynamic_etag,
+                    version = COALESCE(excluded.version, version),
+                    updated_at = excluded.updated_at
+                """, (hexname, static_etag, dynamic_etag, version, int(time.time()))
+            )
+            stats['hexes'] += 1
+        # Every write to the map tables bumps the stamp, an unchanged stamp means nothing changed
+        after = staticStamp(self.cur)
+        if after != before:
+            self._map_changed = True
+            self._map_stamps = (self._map_stamps[0] if self._map_stamps else before, after)
+        self._commit()
+        return stats
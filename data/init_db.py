@@ -1,259 +1,189 @@
 import sqlite3
+import asyncio
+import argparse
 import json
-import csv
+from contextlib import contextmanager
 
-from foxapi import FoxAPI
+from data.migrations import migrate, backfill_preset_items
+from data.map_crawler import HttpBackend, crawl_map
+from data.world_sync import getMajorLabels, assignStructures
+from data.snapshot import refreshSnapshot
 
 CATALOG_PATH = './infantry-59/'
 DB_PATH = "test.db"
-api = FoxAPI(shard='1')
-
-# Taken from https://github.com/clapfoot/warapi?tab=readme-ov-file#map-icons
-ICON_TYPES = {
-    17: 'Refinery', 
-    33: 'Storage Depot', 
-    34: 'Factory', 
-    51: 'Mass Production Factory', 
-    52: 'Seaport'
-}
-
-# Fetches town & structure data from the Foxhole API and writes to CSV files
-def getTownsAndStructures():
-    hexes = api.get_maps_sync()
+SHARD = '1'
+
+# Fetches town & structure data from the Foxhole API
+# Hexes are crawled concurrently, pass a ReplayBackend to build from recorded responses
+# Returns {town_name: {'region', 'x', 'y', 'structures': [{'type', 'x', 'y'}]}}
+def crawlMap(backend=None):
+    if backend is None:
+        backend = HttpBackend(SHARD)
+    results, seconds = asyncio.run(crawl_map(backend))
+    print(f'Crawled {len(results)} hexes in {seconds:.1f}s')
     major_labels = {}
+    for result in results:
+        labels = getMajorLabels(result['static'])
+        if not labels:
+            print(f"No labels found for {result['hex']}")
+        for name, structures in assignStructures(labels, result['dynamic']).items():
+            x, y = labels[name]
+            major_labels[name] = {'region':result['hex'],'structures':structures,'x':x,'y':y}
+    return major_labels
+
+ITEM_HEADERS = [
+    'code_name', 'display_name', 'category', 'per_crate', 'factory_queue',
+    'mpf_queue', 'faction', 'reserve_max_quantity',
+    'shippable_type', 'ingredients', 'description'
+]
+
+# Yields one items row per entry of the FIR catalog json, in ITEM_HEADERS order
+def catalogRows(catalog):
+    for item in catalog:
+        category = ''
+        if 'ItemCategory' in item:
+            category = item['ItemCategory']
+        elif 'VehicleProfileType' in item:
+            category = item['VehicleProfileType']
+
+        ingredients = item.get('ItemDynamicData', {}).get('CostPerCrate', [])
+        if ingredients != []:
+            ingredients = json.dumps(ingredients, separators=(',', ':'))
+        else:
+            ingredients = ''
+
+        yield (
+            item.get('CodeName', ''),
+            item.get('DisplayName', ''),
+            category,
+            item.get('ItemDynamicData', {}).get('QuantityPerCrate', ''),
+            item.get('ProductionCategories', {}).get('Factory', ''),
+            item.get('ProductionCategories', {}).get('MassProductionFactory', ''),
+            item.get('FactionVariant', ''),
+            item.get('ItemProfileData', {}).get('ReserveStockpileMaxQuantity', ''),
+            item.get('ShippableInfo', ''),
+            ingredients,
+            item.get('Description', '')
+        )
 
-    for hexname in hexes:
-        hex_static = api.get_static_sync(hexname)
-        hex_dynamic = api.get_dynamic_sync(hexname)
-
-        # Get map labels
-        hex_labels = {}
-        if len(hex_static['mapTextItems']) == 0:
-            print(f'No labels found for {hexname}')
-        for location in hex_static['mapTextItems']:
-            if location['mapMarkerType'] == 'Major':
-                hex_labels[location['text']] = {
-                    'structures':[],'x':location['x'],'y':location['y']
-                }
-
-        # Find relevant structures and attach them to major labels
-        for icon in hex_dynamic['mapItems']:
-            if icon['iconType'] in ICON_TYPES.keys():
-                closest_town = ''
-                shortest_dist = float('inf')
-                # Find structure's town
-                for k,v in hex_labels.items():
-                    dist_to_town = abs(v['x']-icon['x']) + abs(v['y']-icon['y'])
-                    if dist_to_town < shortest_dist:
-                        closest_town = k
-                        shortest_dist = dist_to_town
-                hex_labels[closest_town]['structures'].append(
-                    {'type':ICON_TYPES[icon['iconType']],'x':icon['x'],'y':icon['y']}
-                )
-        major_labels.update(hex_labels)
-
-    # Write csv files
-    towns_headers = ['name','x','y']
-    with open(CATALOG_PATH+'towns.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(towns_headers)
-        for k, v in major_labels.items():
-            if v['structures'] == []:
-                continue
-            row = [k,v['x'],v['y']]
-            writer.writerow(row)
-    print('Towns CSV created')
-
-    structures_headers = ['town_name','type','x','y']
-    with open(CATALOG_PATH+'structures.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(structures_headers)
-        for k,v in major_labels.items():
-            for struct in v['structures']:
-                row = [k,struct['type'],struct['x'],struct['y']]
-                writer.writerow(row)
-    print('Structures CSV created')
-
-
-# Parses item catalog json and writes CSV file
+def init_db_tables(db_path):
+    """Initialize the database, creating or upgrading tables through the schema migrations."""
+    version = migrate(db_path)
+    print(f"Database tables created (schema version {version}).")
+
+# Opens a connection tuned for bulk loads
+# Durability is relaxed for loads into a fresh database: a crash mid-load means rerunning it
+# A database that already holds guild data keeps full durability, since a crash there must not corrupt it
+@contextmanager
+def bulk_connection(db_path, fresh=False):
+    conn = sqlite3.connect(db_path)
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    relaxed = fresh and journal_mode != 'wal'
+    conn.execute("PRAGMA synchronous = OFF" if fresh else "PRAGMA synchronous = FULL")
+    if relaxed:
+        conn.execute("PRAGMA journal_mode = MEMORY")
+    try:
+        with conn:
+            yield conn.cursor()
+    finally:
+        if relaxed:
+            conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        conn.close()
+
+# Inserts towns and structures for a fresh database, town ids are resolved through a name -> id dict
+def insertMap(cursor, major_labels):
+    cursor.executemany(
+        "INSERT INTO towns (name, region, x, y) VALUES (?, ?, ?, ?)",
+        ((k, v['region'], v['x'], v['y']) for k, v in major_labels.items() if v['structures'])
+    )
+    cursor.execute("SELECT name, id FROM towns")
+    town_ids = dict(cursor.fetchall())
+    cursor.executemany(
+        "INSERT INTO structures (town_id, type, x, y) VALUES (?, ?, ?, ?)",
+        ((town_ids[k], s['type'], s['x'], s['y']) for k, v in major_labels.items() if k in town_ids for s in v['structures'])
+    )
+
+# Loads crawled map data straight into the database
+def load_map(db_path, major_labels):
+    with bulk_connection(db_path, fresh=True) as cursor:
+        insertMap(cursor, major_labels)
+    print("Map data loaded successfully.")
+
+# Loads the FIR catalog json straight into the items table
 # Catalog json copied from https://github.com/GICodeWarrior/fir
 # ^^ MUST BE UPDATED MANUALLY ^^
-def getItems():
-    with open(CATALOG_PATH+'catalog.json', 'r', encoding='utf-8') as f:
+# On a database that already has items, rows are diffed on code_name so item ids (and guild data) survive:
+# new items are inserted, changed ones updated in place, and items gone from the catalog are
+# deleted unless quotas, inventory, presets, inventory history or dispatch tasks still use them
+# Pass fresh only while building a new database, it relaxes durability for the load
+def load_catalog(db_path, catalog_file, fresh=False):
+    with open(catalog_file, 'r', encoding='utf-8') as f:
         catalog = json.load(f)
 
-    headers = [
-        'code_name', 'display_name', 'category', 'per_crate', 'factory_queue',
-        'mpf_queue', 'faction', 'reserve_max_quantity',
-        'shippable_type', 'ingredients', 'description'
-    ]
-    with open(CATALOG_PATH+'items.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)
-
-        for item in catalog:
-            category = ''
-            if 'ItemCategory' in item:
-                category = item['ItemCategory']
-            elif 'VehicleProfileType' in item:
-                category = item['VehicleProfileType']
-
-            ingredients = item.get('ItemDynamicData', {}).get('CostPerCrate', [])
-            if ingredients != []:
-                ingredients = json.dumps(ingredients, separators=(',', ':'))
+    stats = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0, 'kept': 0}
+    columns = ', '.join(ITEM_HEADERS)
+    with bulk_connection(db_path, fresh) as cursor:
+        cursor.execute(f"SELECT id, {columns} FROM items")
+        existing = {r[1]: r for r in cursor.fetchall()}
+
+        inserts = []
+        updates = []
+        for row in catalogRows(catalog):
+            old = existing.pop(row[0], None)
+            if old is None:
+                inserts.append(row)
+            elif tuple(old[1:]) != row:
+                updates.append((*row[1:], old[0]))
             else:
-                ingredients = ''
-
-            row = [
-                item.get('CodeName', ''),
-                item.get('DisplayName', ''),
-                category,
-                item.get('ItemDynamicData', {}).get('QuantityPerCrate', ''),
-                item.get('ProductionCategories', {}).get('Factory', ''),
-                item.get('ProductionCategories', {}).get('MassProductionFactory', ''),
-                item.get('FactionVariant', ''),
-                item.get('ItemProfileData', {}).get('ReserveStockpileMaxQuantity', ''),
-                item.get('ShippableInfo', ''),
-                ingredients,
-                item.get('Description', '')
-            ]
-            writer.writerow(row)
-
-    print('Items CSV created')        
-
-
-def init_db_tables(db_path):
-    """Initialize the database and create tables if they do not exist."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.executescript("""
-    CREATE TABLE IF NOT EXISTS guilds (
-        id INTEGER PRIMARY KEY,
-        name TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS towns (
-        id INTEGER PRIMARY KEY,
-        name TEXT NOT NULL UNIQUE
-    );
-                  
-    CREATE TABLE IF NOT EXISTS structures (
-        id INTEGER PRIMARY KEY,
-        town_id INTEGER NOT NULL,
-        type TEXT NOT NULL,
-        FOREIGN KEY (town_id) REFERENCES towns(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS stockpiles (
-        id INTEGER PRIMARY KEY,
-        name TEXT NOT NULL,
-        guild_id INTEGER NOT NULL,
-        structure_id INTEGER NOT NULL,
-        FOREIGN KEY (guild_id) REFERENCES guilds(id),
-        FOREIGN KEY (structure_id) REFERENCES structures(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS items (
-        id INTEGER PRIMARY KEY,
-        code_name TEXT NOT NULL UNIQUE,
-        display_name TEXT NOT NULL,
-        category TEXT,
-        per_crate INTEGER,
-        factory_queue TEXT,
-        mpf_queue TEXT,
-        faction TEXT,
-        reserve_max_quantity INTEGER,
-        shippable_type TEXT,
-        ingredients TEXT,
-        description TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS inventory (
-        item_id INTEGER NOT NULL,
-        stock_id INTEGER NOT NULL,
-        crates INTEGER NOT NULL DEFAULT 0,
-        non_crates INTEGER NOT NULL DEFAULT 0,
-        PRIMARY KEY (item_id, stock_id),
-        FOREIGN KEY (item_id) REFERENCES items(id),
-        FOREIGN KEY (stock_id) REFERENCES stockpiles(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS quotas (
-        stock_id INTEGER NOT NULL,
-        item_id INTEGER NOT NULL,
-        amount INTEGER NOT NULL,
-        PRIMARY KEY (stock_id, item_id),
-        FOREIGN KEY (stock_id) REFERENCES stockpiles(id),
-        FOREIGN KEY (item_id) REFERENCES items(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS routes (
-        id INTEGER PRIMARY KEY,
-        from_id INTEGER NOT NULL,
-        to_id INTEGER NOT NULL,
-        est_length INTEGER NOT NULL,
-        UNIQUE (from_id, to_id),
-        FOREIGN KEY (from_id) REFERENCES towns(id),
-        FOREIGN KEY (to_id) REFERENCES towns(id)
-    );
-                         
-    CREATE TABLE IF NOT EXISTS presets (
-        name TEXT NOT NULL PRIMARY KEY,
-        quota_string TEXT NOT NULL,
-        guild_id INTEGER NOT NULL,
-        FOREIGN KEY (guild_id) REFERENCES guilds(id)
-    );
-    """)
-
-    conn.commit()
-    conn.close()
-    print("Database tables created.")
-
-def load_csv_to_db(db_path, catalog_path):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    with open(CATALOG_PATH+"towns.csv", newline='', encoding="utf-8") as f:
-        reader = csv.reader(f)
-        next(reader)
-        cursor.executemany("INSERT INTO towns (name) VALUES (?)", ((row[0],) for row in reader))
-
-    with open(CATALOG_PATH+"structures.csv", newline='', encoding="utf-8") as f:
-        reader = csv.reader(f)
-        next(reader)
-        for row in reader:
-            town_name, structure_type = row[0], row[1]
-
-            # Get town_id
-            cursor.execute("SELECT id FROM towns WHERE name = ?", (town_name,))
-            town_id = cursor.fetchone()
-            if town_id:
-                cursor.execute(
-                    "INSERT INTO structures (town_id, type) VALUES (?, ?)",
-                    (town_id[0], structure_type)
-                )
-            else:
-                print(f"Warning: Town '{town_name}' not found in towns table.")
-
-    with open(CATALOG_PATH+"items.csv", newline='', encoding="utf-8") as f:
-        reader = csv.reader(f)
-        next(reader)
-        cursor.executemany("""
-            INSERT INTO items (code_name, display_name, category, per_crate, 
-                           factory_queue, mpf_queue, faction, reserve_max_quantity, 
-                           shippable_type, ingredients, description)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-            reader
+                stats['unchanged'] += 1
+        cursor.executemany(
+            f"INSERT INTO items ({columns}) VALUES ({', '.join('?' * len(ITEM_HEADERS))})", inserts
+        )
+        cursor.executemany(
+            f"UPDATE items SET {', '.join(c + ' = ?' for c in ITEM_HEADERS[1:])} WHERE id = ?", updates
         )
 
+        cursor.execute("""
+            SELECT item_id FROM quotas
+            UNION SELECT item_id FROM inventory
+            UNION SELECT item_id FROM preset_items
+            UNION SELECT item_id FROM inventory_history
+            UNION SELECT item_id FROM tasks
+            """
+        )
+        in_use = {r[0] for r in cursor.fetchall()}
+        removed = [old[0] for old in existing.values()]
+        deletes = [(item_id,) for item_id in removed if item_id not in in_use]
+        cursor.executemany("DELETE FROM items WHERE id = ?", deletes)
+
+        stats['inserted'] = len(inserts)
+        stats['updated'] = len(updates)
+        stats['deleted'] = len(deletes)
+        stats['kept'] = len(removed) - len(deletes)
+    print("Catalog loaded: {inserted} new, {updated} updated, {unchanged} unchanged, {deleted} removed, {kept} removed but still in use".format(**stats))
+    return stats
+
+# Fills preset_items for presets that were stored as quota strings only
+def normalize_presets(db_path):
+    conn = sqlite3.connect(db_path)
+    backfill_preset_items(conn.cursor())
     conn.commit()
     conn.close()
-    print("CSV data loaded successfully.")
+    print("Presets normalized.")
 
 if __name__ == "__main__":
-    getTownsAndStructures()
-    getItems()
-    init_db_tables(DB_PATH)
-    load_csv_to_db(DB_PATH, CATALOG_PATH)
+    parser = argparse.ArgumentParser(description='Build the bot database from the war API and the FIR catalog')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--catalog', default=CATALOG_PATH+'catalog.json')
+    parser.add_argument('--upgrade-catalog', action='store_true',
+                        help='only update the items of an existing database to a new catalog version')
+    args = parser.parse_args()
+
+    init_db_tables(args.db)
+    if not args.upgrade_catalog:
+        load_map(args.db, crawlMap())
+    load_catalog(args.db, args.catalog, fresh=not args.upgrade_catalog)
+    normalize_presets(args.db)
+    refreshSnapshot(args.db)
+    print("Static snapshot written")
     print("Database initialized")
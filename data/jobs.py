@@ -0,0 +1,105 @@
+import io
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from data.db_io import parseTsvByStockpile, singleStockpile
+
+INGEST_WORKERS = 4
+# Largest TSV upload accepted, FIR exports of a full base stay well below this
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024
+
+# Decodes and parses an uploaded TSV, raising ValueError for anything that is not a valid FIR export
+# Returns parseTsvByStockpile groups, or the items of its only stockpile when by_stockpile is False
+def parseUpload(data, by_stockpile=True):
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("Invalid TSV file, it is not UTF-8 text")
+    groups = parseTsvByStockpile(io.StringIO(text, newline=''))
+    return groups if by_stockpile else singleStockpile(groups)
+
+
+class IngestJob():
+    """One queued TSV upload, status goes queued -> running -> done or failed."""
+    def __init__(self, job_id, guild_id, stock_id):
+        self.id = job_id
+        self.guild_id = guild_id
+        self.stock_id = stock_id
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+
+
+class IngestQueue():
+    """Runs TSV inventory uploads in the background so commands reply straight away.
+
+    Downloads happen on the event loop, decoding and parsing on a small
+    thread pool, and the parsed rows go through the database's writer so
+    writes stay serialized. Jobs of one guild run one at a time in the order
+    they were submitted, so a later upload always lands after an earlier one,
+    while jobs of different guilds download and parse side by side.
+    """
+    def __init__(self, db, workers=INGEST_WORKERS):
+        self.db = db
+        self._parsers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+        self._ids = itertools.count(1)
+        # guild_id -> [lock, jobs holding or waiting for it], dropped once no job of the guild is left
+        # asyncio locks wake waiters in arrival order
+        self._guild_locks = {}
+        self._running = set()
+
+    def __len__(self):
+        return len(self._running)
+
+    # Queues an upload and returns its job, on_done(job) is awaited once it finished either way
+    # fetch is a coroutine function returning the file's bytes, typically discord.Attachment.read
+    def submit(self, guild_id, stock_id, fetch, on_done):
+        job = IngestJob(next(self._ids), guild_id, stock_id)
+        task = asyncio.ensure_future(self._run(job, fetch, on_done))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        return job
+
+    async def _run(self, job, fetch, on_done):
+        entry = self._guild_locks.get(job.guild_id)
+        if entry is None:
+            entry = self._guild_locks[job.guild_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            try:
+                async with entry[0]:
+                    job.status = 'running'
+                    job.result = await self._ingest(job, fetch)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._guild_locks[job.guild_id]
+            job.status = 'done'
+        except ValueError as e:
+            job.status = 'failed'
+            job.error = str(e)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = 'Update failed, try again later'
+            print(f'Ingest job {job.id} failed: {e!r}')
+        try:
+            await on_done(job)
+        except Exception as e:
+            print(f'Ingest job {job.id} could not report back: {e!r}')
+
+    async def _ingest(self, job, fetch):
+        data = await fetch()
+        loop = asyncio.get_running_loop()
+        parsed = await loop.run_in_executor(self._parsers, parseUpload, data, job.stock_id is None)
+        if job.stock_id is None:
+            return await self.db.ingestInventories(job.guild_id, parsed)
+        return await self.db.ingestInventory(job.guild_id, job.stock_id, parsed)
+
+    # Waits for every submitted job to finish
+    async def drain(self):
+        while self._running:
+            await asyncio.wait(set(self._running))
+
+    def close(self):
+        self._parsers.shutdown(wait=True)
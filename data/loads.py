@@ -0,0 +1,86 @@
+import time
+import random
+import argparse
+from collections import namedtuple
+
+# A vehicle class, slots is how many crates (or shippables) one trip carries
+# shippables says whether it hauls items that ship as shippables (shippable_type set) instead of plain crates
+Vehicle = namedtuple('Vehicle', ['name', 'slots', 'shippables'])
+
+# Add new classes here, the key is what /loads takes
+VEHICLES = {
+    'truck': Vehicle('Truck', 15, False),
+    'flatbed': Vehicle('Flatbed', 1, True),
+}
+
+# One stockpile's deficit of one item, units is crates * per_crate
+Lot = namedtuple('Lot', ['stock_id', 'stock_name', 'item', 'crates', 'units'])
+
+# Packs lots into as few trips of `slots` crates as possible, returns [[Lot]] with one list per trip
+# Lots bigger than a vehicle are split into full loads first, the remainders are placed with best fit
+# decreasing so a remainder is never split over two trips, which stays within 11/9 of the optimum
+# Trips are bucketed by free space, so each placement is O(slots) rather than a scan over every trip
+def packTrips(lots, slots):
+    trips = []
+    # free[n] holds the indexes of trips with n slots left
+    free = [[] for _ in range(slots + 1)]
+    remainders = []
+    for lot in lots:
+        per_crate = lot.units / lot.crates if lot.crates else 0
+        full, rest = divmod(lot.crates, slots)
+        for _ in range(full):
+            trips.append([lot._replace(crates=slots, units=round(slots * per_crate))])
+        if rest:
+            remainders.append(lot._replace(crates=rest, units=round(rest * per_crate)))
+
+    remainders.sort(key=lambda lot: lot.crates, reverse=True)
+    for lot in remainders:
+        for space in range(lot.crates, slots + 1):
+            if free[space]:
+                trip = free[space].pop()
+                break
+        else:
+            trip = len(trips)
+            trips.append([])
+            space = slots
+        trips[trip].append(lot)
+        free[space - lot.crates].append(trip)
+    return trips
+
+# Packs lots per destination town, {town: [Lot]} -> [{'town', 'crates', 'loads': [Lot]}]
+# Trips are ordered by town, fullest first
+def planTrips(lots_by_town, slots):
+    plan = []
+    for town in sorted(lots_by_town):
+        trips = packTrips(lots_by_town[town], slots)
+        trips.sort(key=lambda trip: sum(lot.crates for lot in trip), reverse=True)
+        for trip in trips:
+            plan.append({'town': town, 'crates': sum(lot.crates for lot in trip), 'loads': trip})
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the load planner on synthetic deficits')
+    parser.add_argument('--towns', type=int, default=60)
+    parser.add_argument('--stockpiles', type=int, default=500)
+    parser.add_argument('--items', type=int, default=30, help='deficits per stockpile')
+    parser.add_argument('--vehicle', default='truck', choices=VEHICLES)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    lots_by_town = {}
+    for stock_id in range(args.stockpiles):
+        town = f'Town {stock_id % args.towns}'
+        for item in range(args.items):
+            crates = rng.randint(1, 40)
+            lots_by_town.setdefault(town, []).append(Lot(stock_id, f'Stockpile {stock_id}', f'Item {item}', crates, crates * 20))
+    slots = VEHICLES[args.vehicle].slots
+    total = sum(lot.crates for lots in lots_by_town.values() for lot in lots)
+
+    start = time.perf_counter()
+    plan = planTrips(lots_by_town, slots)
+    seconds = time.perf_counter() - start
+    lower_bound = sum(-(-sum(lot.crates for lot in lots) // slots) for lots in lots_by_town.values())
+    print(f'{args.stockpiles * args.items} deficits, {total} crates: {len(plan)} trips '
+          f'(lower bound {lower_bound}) in {seconds:.3f}s')
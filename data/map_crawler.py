@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import aiohttp
+
+# Documented at https://github.com/clapfoot/warapi
+WAR_API_URLS = {
+    '1': 'https://war-service-live.foxholeservices.com/api/worldconquest',
+    '2': 'https://war-service-live-2.foxholeservices.com/api/worldconquest',
+    '3': 'https://war-service-live-3.foxholeservices.com/api/worldconquest'
+}
+
+CONCURRENCY = 8
+RETRIES = 3
+BACKOFF = 0.5
+TIMEOUT = 15
+
+# Status codes worth retrying, everything else non-200/304 is an error straight away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def maps_endpoint():
+    return '/maps'
+
+def static_endpoint(hexname):
+    return f'/maps/{hexname}/static'
+
+def dynamic_endpoint(hexname):
+    return f'/maps/{hexname}/dynamic/public'
+
+
+class ApiError(Exception):
+    def __init__(self, endpoint, status):
+        super().__init__(f'{endpoint} returned HTTP {status}')
+        self.endpoint = endpoint
+        self.status = status
+
+
+class HttpBackend():
+    """Fetches war API endpoints over HTTP, honouring ETags."""
+    def __init__(self, shard='1', timeout=TIMEOUT):
+        self.base_url = WAR_API_URLS[str(shard)]
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+        self._session = None
+
+    # Returns (status, json or None, etag), status is 304 when etag is still current
+    async def fetch(self, endpoint, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        async with self._session.get(self.base_url + endpoint, headers=headers) as resp:
+            if resp.status == 304:
+                return 304, None, etag
+            if resp.status != 200:
+                return resp.status, None, None
+            return 200, await resp.json(), resp.headers.get('ETag')
+
+
+class ReplayBackend():
+    """Serves recorded war API responses from a directory of JSON fixtures.
+
+    An endpoint maps to a file under the directory, e.g. /maps/DeadLandsHex/static
+    is read from maps/DeadLandsHex/static.json. A latency in seconds can be
+    injected per request to benchmark the crawl without the network.
+    """
+    def __init__(self, fixture_dir, latency=0.0):
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def path(self, endpoint):
+        return os.path.join(self.fixture_dir, *endpoint.strip('/').split('/')) + '.json'
+
+    async def fetch(self, endpoint, etag=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = self.path(endpoint)
+        if not os.path.exists(path):
+            return 404, None, None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # Recorded responses carry the war API's version field, which doubles as the ETag
+        version = str(data.get('version')) if isinstance(data, dict) and 'version' in data else None
+        if etag is not None and version == etag:
+            return 304, None, etag
+        return 200, data, version
+
+
+class RecordingBackend():
+    """Wraps another backend and saves every 200 response as a ReplayBackend fixture."""
+    def __init__(self, backend, fixture_dir):
+        self.backend = backend
+        self.replay = ReplayBackend(fixture_dir)
+
+    async def __aenter__(self):
+        await self.backend.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.backend.__aexit__(*exc)
+
+    async def fetch(self, endpoint, etag=None):
+        status, data, new_etag = await self.backend.fetch(endpoint, etag)
+        if status == 200:
+            path = self.replay.path(endpoint)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+        return status, data, new_etag
+
+
+class MapCrawler():
+    """Crawls every hex of the war API concurrently.
+
+    At most `concurrency` requests are in flight, failed requests are retried
+    with exponential backoff and every hex records how long it took.
+    """
+    def __init__(self, backend, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF):
+        self.backend = backend
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    # Fetches one endpoint, returns (status, json or None, etag)
+    async def fetch(self, endpoint, etag=None):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._semaphore:
+                    status, data, new_etag = await self.backend.fetch(endpoint, etag)
+                if status in (200, 304):
+                    return status, data, new_etag
+                if status not in RETRY_STATUSES:
+                    raise ApiError(endpoint, status)
+                error = ApiError(endpoint, status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+        raise error
+
+    async def getMaps(self):
+        _, hexes, _ = await self.fetch(maps_endpoint())
+        return hexes
+
+    # Fetches a hex's static and dynamic data together
+    # etags is an optional (static, dynamic) pair, unchanged data comes back as None
+    async def crawlHex(self, hexname, etags=(None, None)):
+        start = time.perf_counter()
+        (_, static, static_etag), (_, dynamic, dynamic_etag) = await asyncio.gather(
+            self.fetch(static_endpoint(hexname), etags[0]),
+            self.fetch(dynamic_endpoint(hexname), etags[1])
+        )
+        return {
+            'hex': hexname,
+            'static': static,
+            'dynamic': dynamic,
+            'etags': (static_etag, dynamic_etag),
+            'seconds': time.perf_counter() - start
+        }
+
+    # Crawls the given hexes, or every hex the API lists, returns results in hex order
+    async def crawl(self, hexes=None, etags=None):
+        if hexes is None:
+            hexes = await self.getMaps()
+        etags = etags or {}
+        return await asyncio.gather(*(self.crawlHex(h, etags.get(h, (None, None))) for h in hexes))
+
+
+# Runs a full crawl and returns (results, total seconds)
+async def crawl_map(backend, concurrency=CONCURRENCY):
+    async with backend:
+        crawler = MapCrawler(backend, concurrency=concurrency)
+        start = time.perf_counter()
+        results = await crawler.crawl()
+        return results, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Crawl the war API map data and report per-hex timings')
+    parser.add_argument('--shard', default='1')
+    parser.add_argument('--replay', metavar='DIR', help='serve responses from recorded fixtures')
+    parser.add_argument('--record', metavar='DIR', help='save live responses as fixtures')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per replayed request')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    if args.replay:
+        backend = ReplayBackend(args.replay, args.latency)
+    else:
+        backend = HttpBackend(args.shard)
+        if args.record:
+            backend = RecordingBackend(backend, args.record)
+    results, total = asyncio.run(crawl_map(backend, args.concurrency))
+    for r in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        print(f"{r['hex']: <24} {r['seconds']:.3f}s")
+    print(f"{len(results)} hexes in {total:.3f}s, sum of per-hex times {sum(r['seconds'] for r in results):.3f}s")
@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds of the latency histogram buckets in seconds, anything slower lands in a final +Inf bucket
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Statements slower than this are kept in the slow query log, which holds the last SLOW_LOG_SIZE of them
+SLOW_QUERY_SECONDS = 0.1
+SLOW_LOG_SIZE = 50
+
+# Nothing is wrapped until enable() is called, so a bot running without metrics pays nothing for them
+enabled = False
+
+def enable(slow_query_seconds=SLOW_QUERY_SECONDS):
+    global enabled
+    registry.slow_query_seconds = slow_query_seconds
+    enabled = True
+
+
+class CallStats():
+    """Latency histogram of one command or DbHandler method, with its query and row totals."""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.failed = 0
+        self.queries = 0
+        self.rows = 0
+
+    def observe(self, seconds, queries, rows, failed):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.failed += failed
+        self.queries += queries
+        self.rows += rows
+
+    # Upper bound of the bucket holding the q-th quantile, the slowest call for the +Inf bucket
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def copy(self):
+        stats = CallStats()
+        stats.__dict__.update(self.__dict__, buckets=self.buckets[:])
+        return stats
+
+
+class Registry():
+    """Call statistics of commands and DbHandler methods, plus the slow query log.
+
+    Written from the event loop and every database thread, so updates take a
+    lock; readers work on copies from snapshot().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.slow_query_seconds = SLOW_QUERY_SECONDS
+        self._calls = {'command': {}, 'db': {}}
+        self._slow = deque(maxlen=SLOW_LOG_SIZE)
+
+    # kind is 'command' or 'db'
+    def record(self, kind, name, seconds, queries=0, rows=0, failed=False):
+        with self._lock:
+            stats = self._calls[kind].get(name)
+            if stats is None:
+                stats = self._calls[kind][name] = CallStats()
+            stats.observe(seconds, queries, rows, failed)
+
+    def recordSlowQuery(self, method, sql, params, seconds):
+        entry = {
+            'at': time.time(),
+            'method': method,
+            'sql': ' '.join(sql.split()),
+            'params': repr(params)[:200],
+            'seconds': seconds,
+        }
+        with self._lock:
+            self._slow.append(entry)
+
+    # Returns ({kind: {name: CallStats}}, [slow queries, newest first]) copied under the lock
+    def snapshot(self):
+        with self._lock:
+            calls = {kind: {name: stats.copy() for name, stats in per_kind.items()} for kind, per_kind in self._calls.items()}
+            slow = list(reversed(self._slow))
+        return calls, slow
+
+    # Renders every histogram in the Prometheus text exposition format
+    def prometheus(self):
+        calls, _ = self.snapshot()
+        lines = []
+        # Commands are not tied to the queries they cause, those only exist per DbHandler call
+        for kind, metric, counters in (('command', 'foxhole_command', ('failed',)), ('db', 'foxhole_db_call', ('failed', 'queries', 'rows'))):
+            lines.append(f'# TYPE {metric}_seconds histogram')
+            for name, stats in sorted(calls[kind].items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+                    cumulative += count
+                    lines.append(f'{metric}_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_seconds_sum{{name="{name}"}} {stats.seconds:.6f}')
+                lines.append(f'{metric}_seconds_count{{name="{name}"}} {stats.count}')
+            for counter in counters:
+                lines.append(f'# TYPE {metric}_{counter}_total counter')
+                for name, stats in sorted(calls[kind].items()):
+                    lines.append(f'{metric}_{counter}_total{{name="{name}"}} {getattr(stats, counter)}')
+        return '\n'.join(lines) + '\n'
+
+    # Writes prometheus() to path, replacing the file whole so scrapers never read a partial one
+    def writePrometheus(self, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+registry = Registry()
+
+# Stack of [method, queries, rows] for the DbHandler calls running on each thread
+_local = threading.local()
+
+def _frames():
+    frames = getattr(_local, 'frames', None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+def _count(queries, rows):
+    # Nested calls are counted inclusively, a batch includes every write in it
+    for frame in _frames():
+        frame[1] += queries
+        frame[2] += rows
+
+
+class InstrumentedCursor():
+    """sqlite3 cursor proxy that times every statement and counts it against the running DbHandler calls.
+
+    Rows are counted as they are fetched for queries and from rowcount for writes.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def _done(self, sql, params, start):
+        seconds = time.perf_counter() - start
+        rowcount = self._cursor.rowcount
+        _count(1, rowcount if rowcount > 0 else 0)
+        if seconds >= registry.slow_query_seconds:
+            frames = _frames()
+            registry.recordSlowQuery(frames[-1][0] if frames else None, sql, params, seconds)
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        self._done(sql, params, start)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        self._cursor.executemany(sql, seq_of_params)
+        self._done(sql, f'{len(seq_of_params)} rows', start)
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            _count(0, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        _count(0, len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            _count(0, 1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _timed(name, method):
+    def call(*args, **kwargs):
+        frames = _frames()
+        frame = [name, 0, 0]
+        frames.append(frame)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            frames.pop()
+            registry.record('db', name, seconds, frame[1], frame[2], failed)
+    call.__name__ = name
+    call.__doc__ = method.__doc__
+    return call
+
+# Swaps a DbHandler's cursor for an InstrumentedCursor and times its public methods
+# Methods are wrapped on the instance, so handlers made while metrics are off stay untouched
+def instrument(handler):
+    handler.cur = InstrumentedCursor(handler.cur)
+    for name in dir(type(handler)):
+        if name.startswith('_'):
+            continue
+        method = getattr(handler, name)
+        if callable(method):
+            setattr(handler, name, _timed(name, method))
@@ -0,0 +1,291 @@
+import os
+import time
+import sqlite3
+
+from data.catalog import CatalogIndex
+from data.db_io import parseQuotas
+
+# Schema as of the first versioned migration
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS guilds (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS towns (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        region TEXT,
+        x REAL,
+        y REAL
+    );
+
+    CREATE TABLE IF NOT EXISTS structures (
+        id INTEGER PRIMARY KEY,
+        town_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        x REAL,
+        y REAL,
+        FOREIGN KEY (town_id) REFERENCES towns(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS stockpiles (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        guild_id INTEGER NOT NULL,
+        structure_id INTEGER NOT NULL,
+        FOREIGN KEY (guild_id) REFERENCES guilds(id),
+        FOREIGN KEY (structure_id) REFERENCES structures(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS items (
+        id INTEGER PRIMARY KEY,
+        code_name TEXT NOT NULL UNIQUE,
+        display_name TEXT NOT NULL,
+        category TEXT,
+        per_crate INTEGER,
+        factory_queue TEXT,
+        mpf_queue TEXT,
+        faction TEXT,
+        reserve_max_quantity INTEGER,
+        shippable_type TEXT,
+        ingredients TEXT,
+        description TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS inventory (
+        item_id INTEGER NOT NULL,
+        stock_id INTEGER NOT NULL,
+        crates INTEGER NOT NULL DEFAULT 0,
+        non_crates INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (item_id, stock_id),
+        FOREIGN KEY (item_id) REFERENCES items(id),
+        FOREIGN KEY (stock_id) REFERENCES stockpiles(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS quotas (
+        stock_id INTEGER NOT NULL,
+        item_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        PRIMARY KEY (stock_id, item_id),
+        FOREIGN KEY (stock_id) REFERENCES stockpiles(id),
+        FOREIGN KEY (item_id) REFERENCES items(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS routes (
+        id INTEGER PRIMARY KEY,
+        from_id INTEGER NOT NULL,
+        to_id INTEGER NOT NULL,
+        est_length INTEGER NOT NULL,
+        UNIQUE (from_id, to_id),
+        FOREIGN KEY (from_id) REFERENCES towns(id),
+        FOREIGN KEY (to_id) REFERENCES towns(id)
+    );
+       
+    CREATE TABLE IF NOT EXISTS presets (
+        name TEXT NOT NULL PRIMARY KEY,
+        quota_string TEXT NOT NULL,
+        guild_id INTEGER NOT NULL,
+        FOREIGN KEY (guild_id) REFERENCES guilds(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS hex_state (
+        hex TEXT NOT NULL PRIMARY KEY,
+        static_etag TEXT,
+        dynamic_etag TEXT,
+        version INTEGER,
+        updated_at INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS preset_items (
+        preset TEXT NOT NULL,
+        item_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        PRIMARY KEY (preset, item_id),
+        FOREIGN KEY (preset) REFERENCES presets(name),
+        FOREIGN KEY (item_id) REFERENCES items(id)
+    );
+"""
+
+# Adds columns that an existing table is missing, columns is {name: type}
+def add_missing_columns(cursor, table, columns):
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {r[1] for r in cursor.fetchall()}
+    for name, col_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
+# Fills preset_items for presets that were stored as quota strings only
+def backfill_preset_items(cursor):
+    catalog = CatalogIndex.load(cursor)
+    cursor.execute("""
+        SELECT name, quota_string FROM presets
+        WHERE name NOT IN (SELECT preset FROM preset_items)
+        """
+    )
+    for preset_name, quota_string in cursor.fetchall():
+        try:
+            quotas = {catalog.resolve(name): amount for name, amount in parseQuotas(quota_string).items()}
+        except ValueError as e:
+            print(f"Warning: Preset '{preset_name}' not converted, {e}")
+            continue
+        cursor.executemany(
+            "INSERT INTO preset_items (preset, item_id, amount) VALUES (?, ?, ?)",
+            [(preset_name, item_id, amount) for item_id, amount in quotas.items()]
+        )
+
+# Creates every table, and brings databases made before schema_version existed up to the same shape
+def baseline(cursor):
+    for statement in BASELINE_SCHEMA.split(';'):
+        if statement.strip():
+            cursor.execute(statement)
+    add_missing_columns(cursor, 'towns', {'region': 'TEXT', 'x': 'REAL', 'y': 'REAL'})
+    add_missing_columns(cursor, 'structures', {'x': 'REAL', 'y': 'REAL'})
+    backfill_preset_items(cursor)
+
+# Secondary indexes for the lookups DbHandler runs on every command
+def add_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stockpiles_guild ON stockpiles (guild_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_structures_town ON structures (town_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_items_display_name ON items (display_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_presets_guild ON presets (guild_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inventory_stock ON inventory (stock_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_towns_region ON towns (region)")
+
+# Write-ahead logging lets readers keep going while the writer commits, the setting persists in the file
+def enable_wal(cursor):
+    cursor.execute("PRAGMA journal_mode = WAL")
+
+# Inventory changes per upload, one row per changed (stockpile, item) holding the difference to the previous upload
+# consumed is the number of crates that went missing, kept separately so rolled up rows still carry it
+def add_inventory_history(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inventory_history (
+            stock_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            recorded_at INTEGER NOT NULL,
+            crates INTEGER NOT NULL,
+            non_crates INTEGER NOT NULL,
+            consumed INTEGER NOT NULL,
+            PRIMARY KEY (stock_id, item_id, recorded_at),
+            FOREIGN KEY (stock_id) REFERENCES stockpiles(id),
+            FOREIGN KEY (item_id) REFERENCES items(id)
+        ) WITHOUT ROWID
+        """
+    )
+
+# Dispatch tasks, one open or claimed task per (stockpile, item) that is below its quota
+# Open tasks are created for the deficits that already exist, scored like data.tasks.taskPriority without a hub
+def add_tasks(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            stock_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            crates INTEGER NOT NULL,
+            priority REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            claimed_by INTEGER,
+            claimed_at INTEGER,
+            created_at INTEGER NOT NULL,
+            completed_at INTEGER,
+            FOREIGN KEY (guild_id) REFERENCES guilds(id),
+            FOREIGN KEY (stock_id) REFERENCES stockpiles(id),
+            FOREIGN KEY (item_id) REFERENCES items(id)
+        )
+        """
+    )
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tasks_active ON tasks (stock_id, item_id) WHERE status != 'done'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_guild ON tasks (guild_id, status, priority)")
+    # Town that task distances are measured from
+    add_missing_columns(cursor, 'guilds', {'hub': 'TEXT'})
+    cursor.execute("""
+        INSERT INTO tasks (guild_id, stock_id, item_id, crates, priority, created_at)
+        SELECT s.guild_id, s.id, q.item_id, q.amount - COALESCE(inv.crates, 0),
+            (q.amount - COALESCE(inv.crates, 0)) * (1 + (q.amount - COALESCE(inv.crates, 0)) * 1.0 / q.amount), ?
+        FROM quotas q
+        JOIN stockpiles s ON s.id = q.stock_id
+        LEFT JOIN inventory inv ON inv.stock_id = q.stock_id AND inv.item_id = q.item_id
+        WHERE q.amount - COALESCE(inv.crates, 0) > 0
+        """, (int(time.time()),)
+    )
+
+# Tables the static snapshot is built from
+STATIC_TABLES = ('items', 'towns', 'structures')
+
+# Version stamp of the static tables, bumped by triggers on every row written to them
+# token tells databases apart, so a snapshot made from one database is never loaded for another
+def add_static_version(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS static_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            token TEXT NOT NULL,
+            version INTEGER NOT NULL
+        )
+        """
+    )
+    cursor.execute("INSERT OR IGNORE INTO static_version (id, token, version) VALUES (1, ?, 0)", (os.urandom(8).hex(),))
+    for table in STATIC_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS static_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE static_version SET version = version + 1;
+                END
+                """
+            )
+
+# Ordered (version, description, function, transactional) entries, append new migrations at the end
+# Non-transactional migrations are for statements sqlite refuses inside a transaction, they must be idempotent
+MIGRATIONS = [
+    (1, 'baseline schema', baseline, True),
+    (2, 'secondary indexes', add_indexes, True),
+    (3, 'write-ahead logging', enable_wal, False),
+    (4, 'inventory history', add_inventory_history, True),
+    (5, 'dispatch tasks', add_tasks, True),
+    (6, 'static data version', add_static_version, True),
+]
+
+# Returns the schema version a database is at, 0 for databases that predate schema_version
+def schema_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER NOT NULL PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+        """
+    )
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+# Applies every pending migration in order, each one in its own transaction
+# Safe to run on every startup, returns the resulting schema version
+def migrate(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        current = schema_version(conn)
+        for version, description, migration, transactional in MIGRATIONS:
+            if version <= current:
+                continue
+            cursor = conn.cursor()
+            if transactional:
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    migration(cursor)
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+            else:
+                migration(cursor)
+                cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, int(time.time()))
+            )
+            cursor.execute("COMMIT")
+            print(f"Applied migration {version}: {description}")
+            current = version
+        return current
+    finally:
+        conn.close()
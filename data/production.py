@@ -0,0 +1,71 @@
+import json
+from types import MappingProxyType
+
+class BillOfMaterials():
+    """Ingredient graph of the catalog, parsed once from the items' CostPerCrate json.
+
+    expand() resolves one crate of an item down to raw materials, the
+    ingredients nothing in the catalog produces. Expansions are memoized per
+    item, so shared intermediates are only walked once, except those that run
+    into a recipe cycle.
+    """
+    def __init__(self, catalog):
+        self._per_crate = {}
+        self._recipes = {}
+        for item in catalog.items.values():
+            self._per_crate[item.code_name] = item.per_crate
+            if not item.ingredients:
+                continue
+            try:
+                cost = json.loads(item.ingredients)
+            except ValueError:
+                continue
+            self._recipes[item.code_name] = tuple((c['ItemCodeName'], c['Quantity']) for c in cost)
+        self._expanded = {}
+
+    def __len__(self):
+        return len(self._recipes)
+
+    def __contains__(self, code_name):
+        return code_name in self._recipes
+
+    # Expansions are left out of pickles, they hold mapping proxies and are cheap to redo
+    def __getstate__(self):
+        return {**self.__dict__, '_expanded': {}}
+
+    # Returns the raw materials for one crate of an item as {code_name: quantity}, None for raw materials
+    def expand(self, code_name):
+        expanded = self._expanded.get(code_name)
+        if expanded is None:
+            expanded, _ = self._expand(code_name, set())
+        return expanded
+
+    # Returns (expansion, whether a recipe cycle was cut anywhere below the item)
+    # What a cut leaves out depends on the path the item was reached by, so such expansions are not memoized
+    def _expand(self, code_name, seen):
+        if code_name in self._expanded:
+            return self._expanded[code_name], False
+        recipe = self._recipes.get(code_name)
+        if recipe is None:
+            return None, False
+        # A recipe that leads back to itself is treated as raw rather than recursing forever
+        if code_name in seen:
+            return None, True
+        seen.add(code_name)
+        totals = {}
+        cut = False
+        for ingredient, quantity in recipe:
+            sub, sub_cut = self._expand(ingredient, seen)
+            cut = cut or sub_cut
+            per_crate = self._per_crate.get(ingredient)
+            if sub is None or not per_crate:
+                totals[ingredient] = totals.get(ingredient, 0) + quantity
+                continue
+            # Ingredients are counted in units, an intermediate's own recipe makes a crate of per_crate units
+            for raw, amount in sub.items():
+                totals[raw] = totals.get(raw, 0) + amount * quantity / per_crate
+        seen.discard(code_name)
+        expanded = MappingProxyType(totals)
+        if not cut:
+            self._expanded[code_name] = expanded
+        return expanded, cut
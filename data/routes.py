@@ -0,0 +1,115 @@
+import heapq
+
+from data.spatial import euclidean
+
+# Rough width of a map hex in metres, war API coordinates are fractions of it
+HEX_WIDTH = 2200
+
+INF = float('inf')
+
+# Estimates the road length in metres between two towns given as (region, x, y)
+# Coordinates are per hex, so towns in different regions return None
+def estimateLength(a, b):
+    if a is None or b is None or a[0] != b[0]:
+        return None
+    return max(round(euclidean(a[1] - b[1], a[2] - b[2]) * HEX_WIDTH), 1)
+
+
+class RouteGraph():
+    """Two-way road graph between towns with every shortest distance precomputed.
+
+    Built from (town, town, length) routes with one Dijkstra run per town, after
+    which distance() is a plain matrix lookup. Graphs are never changed in place:
+    withRoute returns an updated copy, so readers always see a complete matrix.
+    """
+    def __init__(self, routes=()):
+        self._adj = {}
+        for a, b, length in routes:
+            self._adj.setdefault(a, {})[b] = length
+            self._adj.setdefault(b, {})[a] = length
+        self._towns = sorted(self._adj)
+        self._index = {town: i for i, town in enumerate(self._towns)}
+        self._dist = [self._shortestFrom(town) for town in self._towns]
+
+    def __len__(self):
+        return len(self._towns)
+
+    def __contains__(self, town):
+        return town in self._index
+
+    # Returns the roads leaving a town as {town: length}
+    def routes(self, town):
+        return dict(self._adj.get(town, {}))
+
+    # Shortest road distance between two towns, inf when there is no connection
+    def distance(self, a, b):
+        i = self._index.get(a)
+        j = self._index.get(b)
+        if i is None or j is None:
+            return 0 if a == b else INF
+        return self._dist[i][j]
+
+    # Dijkstra from one town, returns its row of the distance matrix
+    def _shortestFrom(self, source):
+        dist = [INF] * len(self._towns)
+        dist[self._index[source]] = 0
+        heap = [(0, source)]
+        while heap:
+            d, town = heapq.heappop(heap)
+            if d > dist[self._index[town]]:
+                continue
+            for neighbour, length in self._adj[town].items():
+                nd = d + length
+                j = self._index[neighbour]
+                if nd < dist[j]:
+                    dist[j] = nd
+                    heapq.heappush(heap, (nd, neighbour))
+        return dist
+
+    # Returns a copy of the graph with the road between a and b set to length, or removed when length is None
+    # A new or shorter road is folded into the matrix in O(n^2), a longer or removed one only
+    # reruns Dijkstra for the towns whose shortest paths used it
+    def withRoute(self, a, b, length=None):
+        old = self._adj.get(a, {}).get(b)
+        if old == length or a == b:
+            return self
+        graph = RouteGraph()
+        graph._adj = {town: dict(roads) for town, roads in self._adj.items()}
+        if length is None:
+            del graph._adj[a][b]
+            del graph._adj[b][a]
+        else:
+            graph._adj.setdefault(a, {})[b] = length
+            graph._adj.setdefault(b, {})[a] = length
+        # New towns are appended so existing matrix rows keep their positions
+        graph._towns = self._towns + [t for t in dict.fromkeys((a, b)) if t not in self._index and t in graph._adj]
+        graph._index = {town: i for i, town in enumerate(graph._towns)}
+        n = len(graph._towns)
+        dist = [row + [INF] * (n - len(row)) for row in self._dist]
+        for i in range(len(dist), n):
+            dist.append([INF] * n)
+            dist[i][i] = 0
+        graph._dist = dist
+
+        u = graph._index[a]
+        v = graph._index[b]
+        if old is None or (length is not None and length < old):
+            for i in range(n):
+                row = dist[i]
+                via_u = row[u] + length
+                via_v = row[v] + length
+                # Nothing from this town gets shorter unless the road shortens the way to its far end
+                if via_u >= row[v] and via_v >= row[u]:
+                    continue
+                row_u = dist[u]
+                row_v = dist[v]
+                for j in range(n):
+                    best = min(via_u + row_v[j], via_v + row_u[j])
+                    if best < row[j]:
+                        row[j] = best
+        else:
+            for i in range(n):
+                row = dist[i]
+                if row[u] + old == row[v] or row[v] + old == row[u]:
+                    dist[i] = graph._shortestFrom(graph._towns[i])
+        return graph
@@ -0,0 +1,119 @@
+import os
+import sys
+import pickle
+import sqlite3
+
+from data.catalog import CatalogIndex
+from data.trie import PrefixTrie
+from data.production import BillOfMaterials
+
+# Bumped whenever the snapshot layout or a class pickled into it changes shape
+SNAPSHOT_FORMAT = 2
+# The snapshot lives next to the database as <db file>.static
+SNAPSHOT_SUFFIX = '.static'
+
+def snapshotPath(db_file):
+    if not db_file or db_file == ':memory:' or db_file.startswith('file:'):
+        return None
+    return db_file + SNAPSHOT_SUFFIX
+
+# Returns the (token, version) stamp of the database's static tables, None before the migration that adds it
+def staticStamp(cur):
+    try:
+        cur.execute("SELECT token, version FROM static_version WHERE id = 1")
+    except sqlite3.OperationalError:
+        return None
+    row = cur.fetchone()
+    return tuple(row) if row else None
+
+# Builds the town and structure lookups from the map tables
+def buildMap(cur):
+    cur.execute("""
+        SELECT t.name, s.type
+        FROM structures s
+        JOIN towns t ON t.id = s.town_id
+        """
+    )
+    town_structures = {}
+    for town, struct_type in cur.fetchall():
+        town_structures.setdefault(town, set()).add(struct_type)
+    cur.execute("SELECT name, region, x, y FROM towns WHERE x IS NOT NULL AND y IS NOT NULL")
+    return {
+        'town_structures': {town: sorted(types) for town, types in town_structures.items()},
+        # town name -> (region, x, y)
+        'town_coords': {r[0]: (r[1], r[2], r[3]) for r in cur.fetchall()},
+        'towns': PrefixTrie(town_structures),
+        'structure_types': PrefixTrie({t for types in town_structures.values() for t in types}),
+    }
+
+# Names of the indexes in a snapshot, each kept under the same attribute of data.cache.Caches
+SNAPSHOT_KEYS = ('catalog', 'items', 'bom', 'town_structures', 'town_coords', 'towns', 'structure_types')
+
+# Builds every static index: the catalog, its tries and bill of materials, and the map lookups
+def buildStatic(cur):
+    catalog = CatalogIndex.load(cur)
+    return {
+        'catalog': catalog,
+        'items': PrefixTrie({item.display_name for item in catalog.items.values()}),
+        'bom': BillOfMaterials(catalog),
+        **buildMap(cur),
+    }
+
+def _header(stamp):
+    return {'format': SNAPSHOT_FORMAT, 'python': tuple(sys.version_info[:2]), 'stamp': tuple(stamp)}
+
+# Returns the static indexes stored at path, None when the file is missing, unreadable or for another stamp
+# The snapshot is a pickle, the indexes are still rebuilt object by object but without a query or a trie insert
+# The header is checked before the indexes are unpickled
+def readSnapshot(path, stamp):
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != _header(stamp):
+                return None
+            return pickle.load(f)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+# Writes the static indexes to path, replacing the file whole so readers never see a partial one
+def writeSnapshot(path, stamp, static):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(_header(stamp), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(static, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+# Returns the static indexes of a database, from its snapshot when that is current
+# A stale or missing snapshot is rebuilt from the tables and written back for the next start
+def loadStatic(cur, db_file):
+    path = snapshotPath(db_file)
+    # Read before the tables, so a snapshot never carries a newer stamp than its contents
+    stamp = staticStamp(cur)
+    if path is None or stamp is None:
+        return buildStatic(cur)
+    static = readSnapshot(path, stamp)
+    if static is None:
+        static = buildStatic(cur)
+        saveStatic(db_file, stamp, static)
+    return static
+
+# Writes the static indexes to the snapshot of db_file, a snapshot that cannot be written is only reported
+def saveStatic(db_file, stamp, static):
+    path = snapshotPath(db_file)
+    if path is None or stamp is None:
+        return
+    try:
+        writeSnapshot(path, stamp, static)
+    except OSError as e:
+        print(f'Could not write static snapshot {path}: {e}')
+
+# Rebuilds the snapshot of the database at db_path, run after the static tables were loaded
+def refreshSnapshot(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        cur = conn.cursor()
+        stamp = staticStamp(cur)
+        if stamp is None:
+            raise ValueError(f'{db_path} predates the static data version, run the migrations first')
+        writeSnapshot(snapshotPath(db_path), stamp, buildStatic(cur))
+    finally:
+        conn.close()
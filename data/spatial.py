@@ -0,0 +1,84 @@
+import heapq
+
+def euclidean(dx, dy):
+    return (dx * dx + dy * dy) ** 0.5
+
+def manhattan(dx, dy):
+    return abs(dx) + abs(dy)
+
+
+class KDTree():
+    """Static 2-d tree over (x, y, value) points for nearest neighbour queries.
+
+    Queries take O(log n) on average. Any metric that is never smaller than the
+    distance along a single axis (euclidean, manhattan) prunes correctly.
+    An empty tree answers every query with no result.
+    """
+    def __init__(self, points, metric=euclidean):
+        self.metric = metric
+        self._size = 0
+        # Nodes are (x, y, value, left, right)
+        self._root = self._build([tuple(p) for p in points], 0)
+
+    def __len__(self):
+        return self._size
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 2
+        points.sort(key=lambda p: p[axis])
+        mid = len(points) // 2
+        x, y, value = points[mid]
+        self._size += 1
+        return (x, y, value, self._build(points[:mid], depth + 1), self._build(points[mid+1:], depth + 1))
+
+    # Returns up to k (distance, value) pairs closest to (x, y), nearest first
+    def nearest(self, x, y, k=1, max_dist=float('inf')):
+        best = []
+        stack = [(self._root, 0, 0)]
+        while stack:
+            node, depth, lower_bound = stack.pop()
+            if node is None or lower_bound > max_dist:
+                continue
+            if len(best) == k and lower_bound >= -best[0][0]:
+                continue
+            nx, ny, value, left, right = node
+            dist = self.metric(nx - x, ny - y)
+            if dist <= max_dist:
+                entry = (-dist, id(node), value)
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, entry)
+            diff = (x - nx) if depth % 2 == 0 else (y - ny)
+            near, far = (left, right) if diff < 0 else (right, left)
+            # The far side is at least abs(diff) away, the near side is pushed last so it is searched first
+            stack.append((far, depth + 1, max(lower_bound, abs(diff))))
+            stack.append((near, depth + 1, lower_bound))
+        return [(-d, value) for d, _, value in sorted(best, reverse=True)]
+
+    # Returns the value closest to (x, y), or None for an empty tree
+    def nearestValue(self, x, y):
+        found = self.nearest(x, y)
+        return found[0][1] if found else None
+
+
+class RegionIndex():
+    """Nearest neighbour index over points that carry a region (map hex) name.
+
+    War API coordinates are normalized per hex, so points are only compared
+    against points of the same region.
+    """
+    def __init__(self, points, metric=euclidean):
+        regions = {}
+        for region, x, y, value in points:
+            regions.setdefault(region, []).append((x, y, value))
+        self._trees = {region: KDTree(p, metric) for region, p in regions.items()}
+
+    def regions(self):
+        return list(self._trees)
+
+    def nearest(self, region, x, y, k=1):
+        tree = self._trees.get(region)
+        return tree.nearest(x, y, k) if tree else []
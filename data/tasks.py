@@ -0,0 +1,55 @@
+import heapq
+
+# Road distance in metres that halves a task's priority
+DISTANCE_SCALE = 1000
+
+# Scores a haul of `crates` towards a quota of `quota`, higher goes first
+# Big deficits and stockpiles that are nearly empty relative to their quota rank up, far away ones rank down
+# Unknown distances count as zero
+def taskPriority(crates, quota, distance=0):
+    shortfall = min(crates / quota, 1.0) if quota > 0 else 1.0
+    if distance == float('inf'):
+        distance = 0
+    return crates * (1 + shortfall) / (1 + distance / DISTANCE_SCALE)
+
+
+class TaskQueue():
+    """Max-heap of a guild's open tasks ordered by priority.
+
+    Entries are invalidated lazily: rescoring or removing a task only updates
+    the priority index, stale heap entries are skipped when they reach the top,
+    so push, remove and pop all stay O(log n) amortized.
+    """
+    def __init__(self, tasks=()):
+        self._priority = dict(tasks)
+        self._heap = [(-priority, task_id) for task_id, priority in self._priority.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._priority)
+
+    def __contains__(self, task_id):
+        return task_id in self._priority
+
+    # Adds a task or changes its priority
+    def push(self, task_id, priority):
+        if self._priority.get(task_id) == priority:
+            return
+        self._priority[task_id] = priority
+        heapq.heappush(self._heap, (-priority, task_id))
+        # Rebuild once stale entries outnumber live ones
+        if len(self._heap) > 2 * len(self._priority) + 64:
+            self._heap = [(-p, t) for t, p in self._priority.items()]
+            heapq.heapify(self._heap)
+
+    def remove(self, task_id):
+        self._priority.pop(task_id, None)
+
+    # Removes and returns the highest priority task id, None when empty
+    def pop(self):
+        while self._heap:
+            priority, task_id = heapq.heappop(self._heap)
+            if self._priority.get(task_id) == -priority:
+                del self._priority[task_id]
+                return task_id
+        return None
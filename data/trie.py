@@ -0,0 +1,72 @@
+import heapq
+
+from data.catalog import normalize
+
+# Most names ranked ahead of time under each node, Discord shows at most 25 autocomplete choices
+TOP_K = 25
+# Node keys besides characters: None holds the names ending at the node,
+# RANKED the best TOP_K names of its whole subtree for the prefix the node spells
+RANKED = ''
+
+# Whole-name matches first then alphabetical
+def rankKey(name, prefix):
+    return (not normalize(name).startswith(prefix), name.casefold(), name)
+
+class PrefixTrie():
+    """Case-insensitive prefix trie mapping typed text to display names.
+
+    Every word start of a name is indexed, so "depot" completes "Storage Depot".
+    Built once from static data and only read afterwards, every node keeps the
+    top ranked names of its subtree so a completion never walks it.
+    """
+    def __init__(self, names=()):
+        self._root = {}
+        self._size = 0
+        for name in names:
+            self._insert(name)
+        self._rank(self._root, '')
+
+    def __len__(self):
+        return self._size
+
+    def _insert(self, name):
+        words = normalize(name).split(' ')
+        for i in range(len(words)):
+            node = self._root
+            for char in ' '.join(words[i:]):
+                node = node.setdefault(char, {})
+            node.setdefault(None, set()).add(name)
+        self._size += 1
+
+    # Fills RANKED bottom up, a node's best names are among its own and its children's best
+    def _rank(self, node, prefix):
+        children = [(char, child) for char, child in node.items() if char]
+        for char, child in children:
+            self._rank(child, prefix + char)
+        # Every name below a lone child starts with this prefix exactly when it starts with the child's
+        if len(children) == 1 and None not in node:
+            node[RANKED] = children[0][1][RANKED]
+            return
+        candidates = set(node.get(None, ()))
+        for _, child in children:
+            candidates.update(child[RANKED])
+        node[RANKED] = tuple(heapq.nsmallest(TOP_K, candidates, key=lambda name: rankKey(name, prefix)))
+
+    # Returns up to limit names matching prefix, whole-name matches first then alphabetical
+    def complete(self, prefix, limit=TOP_K):
+        prefix = normalize(prefix)
+        node = self._root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        if limit <= TOP_K:
+            return list(node[RANKED][:limit])
+        # Longer lists than were ranked ahead of time walk the whole subtree
+        found = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            found.update(node.get(None, ()))
+            stack.extend(child for char, child in node.items() if char)
+        return sorted(found, key=lambda name: rankKey(name, prefix))[:limit]
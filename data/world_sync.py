@@ -0,0 +1,98 @@
+import time
+
+from data.map_crawler import MapCrawler, CONCURRENCY
+from data.spatial import KDTree, manhattan, euclidean
+
+# Taken from https://github.com/clapfoot/warapi?tab=readme-ov-file#map-icons
+ICON_TYPES = {
+    17: 'Refinery',
+    33: 'Storage Depot',
+    34: 'Factory',
+    51: 'Mass Production Factory',
+    52: 'Seaport'
+}
+
+# Returns the Major map labels of a hex's static data as {name: (x, y)}
+def getMajorLabels(hex_static):
+    return {
+        location['text']: (location['x'], location['y'])
+        for location in hex_static.get('mapTextItems', [])
+        if location['mapMarkerType'] == 'Major'
+    }
+
+# Assigns a hex's relevant structures to its nearest major label
+# labels is {name: (x, y)}, returns {name: [{'type', 'x', 'y'}]} with an entry for every label
+def assignStructures(labels, hex_dynamic):
+    assigned = {name: [] for name in labels}
+    if not labels:
+        return assigned
+    # Manhattan distance, as the original label scan used
+    towns = KDTree([(x, y, name) for name, (x, y) in labels.items()], manhattan)
+    for icon in hex_dynamic.get('mapItems', []):
+        if icon['iconType'] in ICON_TYPES:
+            assigned[towns.nearestValue(icon['x'], icon['y'])].append(
+                {'type':ICON_TYPES[icon['iconType']],'x':icon['x'],'y':icon['y']}
+            )
+    return assigned
+
+# Pairs a hex's stored structures with the ones found in fresh map data
+# existing is [(id, town_id, type, x, y, in_use)], found is [(town_id, type, x, y)]
+# Structures of the same town and type are paired closest first, so ids (and stockpiles) stay attached
+# Returns (updates [(x, y, id)] of moved structures, inserts [(town_id, type, x, y)], deletes [id], kept [id])
+def matchStructures(existing, found):
+    groups = {}
+    for row in existing:
+        groups.setdefault((row[1], row[2]), ([], []))[0].append(row)
+    for row in found:
+        groups.setdefault((row[0], row[1]), ([], []))[1].append(row)
+
+    updates, inserts, deletes, kept = [], [], [], []
+    for old_rows, new_rows in groups.values():
+        pairs = []
+        for old in old_rows:
+            for new in new_rows:
+                # Rows stored before coordinates were kept match anything
+                dist = 0 if old[3] is None or old[4] is None else euclidean(old[3] - new[2], old[4] - new[3])
+                pairs.append((dist, old, new))
+        pairs.sort(key=lambda p: p[0])
+        matched_old = set()
+        matched_new = set()
+        for _, old, new in pairs:
+            if old[0] in matched_old or id(new) in matched_new:
+                continue
+            matched_old.add(old[0])
+            matched_new.add(id(new))
+            # Structures that did not move are left alone, so an unchanged hex writes nothing
+            if (old[3], old[4]) != (new[2], new[3]):
+                updates.append((new[2], new[3], old[0]))
+        inserts.extend(new for new in new_rows if id(new) not in matched_new)
+        for old in old_rows:
+            if old[0] in matched_old:
+                continue
+            # Structures that stockpiles point at are kept so their foreign keys stay valid
+            (kept if old[5] else deletes).append(old[0])
+    return updates, inserts, deletes, kept
+
+
+class WorldSync():
+    """Keeps towns and structures in step with the war API.
+
+    Per-hex ETags are stored in the hex_state table, so only hexes whose map
+    data changed since the last refresh are fetched and re-imported.
+    """
+    def __init__(self, db, backend, concurrency=CONCURRENCY):
+        self.db = db
+        self.backend = backend
+        self.concurrency = concurrency
+
+    # Crawls changed hexes and applies them, returns the import counts
+    async def refresh(self):
+        start = time.perf_counter()
+        etags = await self.db.fetchHexState()
+        async with self.backend:
+            crawler = MapCrawler(self.backend, concurrency=self.concurrency)
+            results = await crawler.crawl(etags=etags)
+        changed = [r for r in results if r['static'] is not None or r['dynamic'] is not None]
+        stats = await self.db.syncHexes(changed) if changed else {'hexes': 0}
+        stats['seconds'] = time.perf_counter() - start
+        return stats
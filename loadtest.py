@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+import discord
+
+# Simulates a burst of slash commands against the real command callbacks of bot.py, without Discord
+# Interactions, their responses and follow-ups are stand-ins that record when each reply was sent,
+# the bot itself, its database handler and its job queue are the real ones on a synthetic database
+
+# Share of each command in the simulated burst
+MIX = {'update': 0.3, 'requirements': 0.4, 'list': 0.3}
+# Gap the stall monitor sleeps for between loop ticks, in seconds
+TICK = 0.001
+
+
+class FakeMessage():
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def edit(self, **kwargs):
+        await self.interaction.apiCall()
+
+
+class FakeResponse():
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+        # How the interaction was answered, as on discord.InteractionResponse
+        self.type = None
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, ephemeral=False, view=None):
+        self._done = True
+        self.type = discord.InteractionResponseType.channel_message
+        await self._interaction.apiCall()
+        self._interaction.sent(content, ephemeral)
+
+    async def defer(self, thinking=False, ephemeral=False):
+        self._done = True
+        self.type = discord.InteractionResponseType.deferred_channel_message
+        await self._interaction.apiCall()
+        self._interaction.deferred_at = time.perf_counter()
+
+
+class FakeFollowup():
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, ephemeral=False, view=None, wait=False):
+        await self._interaction.apiCall()
+        self._interaction.sent(content, ephemeral)
+        return FakeMessage(self._interaction)
+
+
+class FakeUser():
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f'User {user_id}'
+
+
+class FakeGuild():
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'Guild {guild_id}'
+
+
+class FakeInteraction():
+    """Just enough of discord.Interaction for the command callbacks.
+
+    Records when the interaction was first answered (ack) and when its last
+    expected message went out (done), a queued /update is done at its follow-up.
+    """
+    def __init__(self, command, guild_id, user_id, expected_messages=1, api_latency=0.0):
+        self.command_name = command
+        self.guild_id = guild_id
+        self.guild = FakeGuild(guild_id)
+        self.user = FakeUser(user_id)
+        self.namespace = None
+        self.extras = {}
+        self.command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.api_latency = api_latency
+        self.expected_messages = expected_messages
+        self.messages = []
+        self.started = time.perf_counter()
+        self.deferred_at = None
+        self.acked_at = None
+        self.finished = asyncio.get_running_loop().create_future()
+
+    async def apiCall(self):
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+    def sent(self, content, ephemeral):
+        now = time.perf_counter()
+        if self.acked_at is None:
+            self.acked_at = self.deferred_at or now
+        self.messages.append((content, ephemeral))
+        if len(self.messages) >= self.expected_messages and not self.finished.done():
+            self.finished.set_result(now)
+
+    async def original_response(self):
+        return FakeMessage(self)
+
+    async def edit_original_response(self, **kwargs):
+        await self.apiCall()
+
+    async def delete_original_response(self):
+        await self.apiCall()
+
+
+class FakeAttachment():
+    def __init__(self, data, filename='stockpiles.tsv'):
+        self.data = data.encode('utf-8')
+        self.size = len(self.data)
+        self.filename = filename
+        self.content_type = 'text/tab-separated-values; charset=utf-8'
+
+    async def read(self):
+        return self.data
+
+
+# Records the longest gaps between event loop ticks until stopped
+class StallMonitor():
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.stalls = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.tick)
+            self.stalls.append(time.perf_counter() - start - self.tick)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    at = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] * 1000
+    return {
+        'count': len(samples),
+        'p50_ms': round(at(0.5), 2),
+        'p95_ms': round(at(0.95), 2),
+        'p99_ms': round(at(0.99), 2),
+        'max_ms': round(samples[-1] * 1000, 2),
+    }
+
+# Fires `count` commands across the layout's guilds, all at once or spread over `spread` seconds
+async def burst(bot, items, layout, count, spread, api_latency, timeout, seed):
+    from data.benchmark import syntheticTsv
+
+    rng = random.Random(seed)
+    guild_ids = list(layout)
+    commands = rng.choices(list(MIX), weights=list(MIX.values()), k=count)
+    interactions = []
+    calls = []
+    for command in commands:
+        guild_id = rng.choice(guild_ids)
+        user_id = rng.randint(1, 10 ** 6)
+        if command == 'update':
+            stock_id = rng.choice(layout[guild_id])
+            attachment = FakeAttachment(syntheticTsv(rng, f'Stockpile {stock_id}', 'Seaport', items))
+            calls.append((bot.update.callback, (attachment, stock_id)))
+            # The queued reply and the job's follow-up
+            expected = 2
+        elif command == 'requirements':
+            calls.append((bot.requirements.callback, (None,)))
+            expected = 1
+        else:
+            calls.append((bot.list.callback, ()))
+            expected = 1
+        interactions.append((command, guild_id, user_id, expected))
+
+    monitor = StallMonitor()
+    monitor.start()
+
+    async def invoke(delay, spec, call):
+        await asyncio.sleep(delay)
+        inter = FakeInteraction(*spec, api_latency=api_latency)
+        callback, args = call
+        await callback(inter, *args)
+        return inter
+
+    start = time.perf_counter()
+    delays = sorted(rng.uniform(0, spread) for _ in range(count)) if spread else [0] * count
+    invoked = await asyncio.gather(*(invoke(d, spec, call) for d, spec, call in zip(delays, interactions, calls)))
+    pending = [inter.finished for inter in invoked if not inter.finished.done()]
+    if pending:
+        await asyncio.wait(pending, timeout=timeout)
+    wall = time.perf_counter() - start
+    await monitor.stop()
+
+    results = {'commands': count, 'wall_seconds': round(wall, 3), 'by_command': {}}
+    for command in MIX:
+        done = [i for i in invoked if i.command_name == command]
+        results['by_command'][command] = {
+            'ack': percentiles([i.acked_at - i.started for i in done if i.acked_at is not None]),
+            'done': percentiles([i.finished.result() - i.started for i in done if i.finished.done()]),
+            'deferred': sum(i.deferred_at is not None for i in done),
+            'unfinished': sum(not i.finished.done() for i in done),
+        }
+    results['loop_stall'] = {
+        'max_ms': round(max(monitor.stalls, default=0) * 1000, 2),
+        'p99_ms': round(sorted(monitor.stalls)[int(len(monitor.stalls) * 0.99)] * 1000, 2) if monitor.stalls else 0,
+        'over_50ms': sum(s > 0.05 for s in monitor.stalls),
+    }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fire concurrent slash commands at the real bot callbacks on a synthetic database')
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--stockpiles', type=int, default=10, help='stockpiles per guild')
+    parser.add_argument('--commands', type=int, default=500)
+    parser.add_argument('--spread', type=float, default=0, help='seconds to spread the commands over, 0 fires them all at once')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds each simulated Discord API call takes')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for queued work to finish')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    from data.benchmark import buildDatabase
+
+    workdir = tempfile.mkdtemp(prefix='foxhole-loadtest-')
+    try:
+        db_path = os.path.join(workdir, 'loadtest.db')
+        items, layout = buildDatabase(db_path, args.guilds, args.stockpiles, args.seed)
+        # bot.py reads its configuration at import, a test guild is never contacted since the bot never logs in
+        os.environ['DB_PATH'] = db_path
+        import bot
+
+        async def main():
+            try:
+                return await burst(bot, items, layout, args.commands, args.spread, args.api_latency, args.timeout, args.seed)
+            finally:
+                await bot.ingest.drain()
+                await bot.db.drain()
+
+        results = asyncio.run(main())
+        bot.ingest.close()
+        bot.db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{results['commands']} commands in {results['wall_seconds']}s")
+    for command, stats in results['by_command'].items():
+        if stats['done'] is None:
+            continue
+        print(f"  {command: <13} ack p50 {stats['ack']['p50_ms']:8.2f} p99 {stats['ack']['p99_ms']:8.2f} ms | "
+              f"done p50 {stats['done']['p50_ms']:8.2f} p99 {stats['done']['p99_ms']:8.2f} max {stats['done']['max_ms']:8.2f} ms | "
+              f"{stats['deferred']} deferred, {stats['unfinished']} unfinished")
+    stall = results['loop_stall']
+    print(f"  event loop stall max {stall['max_ms']} ms, p99 {stall['p99_ms']} ms, {stall['over_50ms']} ticks over 50 ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,177 @@
+import asyncio
+
+import discord
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+# Replies still rendering after this many seconds are deferred, interactions expire after 3
+DEFER_AFTER = 1.5
+# Seconds the page buttons keep working after the last click
+PAGE_TIMEOUT = 300
+
+# Splits a table into code block pages that each fit in one message, header is repeated on every page
+# Rows too long for a page on their own are split over several rather than cut
+def chunkRows(header, rows, limit=MESSAGE_LIMIT):
+    # Room left for rows once the fences and header are in
+    room = limit - len(header) - len('```\n```')
+    page = []
+    size = 0
+    for row in rows:
+        pieces = [row[i:i + room] for i in range(0, len(row), room)] or ['']
+        for piece in pieces:
+            if page and size + len(piece) + 1 > room:
+                yield '```' + header + '\n' + '\n'.join(page) + '```'
+                page = []
+                size = 0
+            page.append(piece)
+            size += len(piece) + 1
+    yield '```' + header + '\n' + '\n'.join(page) + '```'
+
+# Splits plain text lines into messages that each fit in one message
+def chunkLines(lines, limit=MESSAGE_LIMIT):
+    message = []
+    size = 0
+    for line in lines:
+        for piece in [line[i:i + limit] for i in range(0, len(line), limit)] or ['']:
+            if message and size + len(piece) + 1 > limit:
+                yield '\n'.join(message)
+                message = []
+                size = 0
+            message.append(piece)
+            size += len(piece) + 1
+    if message:
+        yield '\n'.join(message)
+
+
+class PageCache():
+    """Rendered pages per guild and command, kept until a write to the guild commits.
+
+    Wraps a GuildCache whose value per guild is {key: pages}, key being the
+    command and its arguments. Entries are replaced whole, so a render that
+    raced a write is dropped by the version check like any other cached value.
+    """
+    def __init__(self, guild_cache):
+        self._pages = guild_cache
+
+    def get(self, guild_id, key):
+        pages = self._pages.get(guild_id)
+        return None if pages is None else pages.get(key)
+
+    def version(self, guild_id):
+        return self._pages.version(guild_id)
+
+    def store(self, guild_id, version, key, pages):
+        current = self._pages.get(guild_id) or {}
+        self._pages.store(guild_id, version, {**current, key: pages})
+
+
+class Paginator(discord.ui.View):
+    """Previous and next buttons over pre-rendered pages, only the user who ran the command can turn them."""
+    def __init__(self, pages, owner_id, timeout=PAGE_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.pages = pages
+        self.owner_id = owner_id
+        self.page = 0
+        self.message = None
+        self._refresh()
+
+    def _refresh(self):
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page == len(self.pages) - 1
+        self.counter.label = f'{self.page + 1}/{len(self.pages)}'
+
+    async def _show(self, inter):
+        self._refresh()
+        await inter.response.edit_message(content=self.pages[self.page], view=self)
+
+    async def interaction_check(self, inter):
+        if inter.user.id != self.owner_id:
+            await inter.response.send_message('Only the user who ran the command can turn its pages', ephemeral=True)
+            return False
+        return True
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous(self, inter, button):
+        self.page = max(self.page - 1, 0)
+        await self._show(inter)
+
+    @discord.ui.button(label='1/1', style=discord.ButtonStyle.secondary, disabled=True)
+    async def counter(self, inter, button):
+        pass
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next(self, inter, button):
+        self.page = min(self.page + 1, len(self.pages) - 1)
+        await self._show(inter)
+
+    # Drops the buttons once they stop working
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view=None)
+        except discord.HTTPException:
+            pass
+
+
+# Replies with a text message, as a follow-up when the interaction was already answered or deferred
+async def reply(inter, content, ephemeral=False):
+    if inter.response.is_done():
+        await inter.followup.send(content, ephemeral=ephemeral)
+    else:
+        await inter.response.send_message(content, ephemeral=ephemeral)
+
+
+# Shows an error to the user alone, also after a public thinking defer
+# The first follow-up to such a defer replaces its placeholder and ignores ephemeral, so the placeholder
+# is resolved and removed first and the error goes out as a separate follow-up
+async def replyError(inter, content):
+    if inter.response.type == discord.InteractionResponseType.deferred_channel_message:
+        try:
+            await inter.edit_original_response(content='\u200b')
+            await inter.delete_original_response()
+        except discord.HTTPException:
+            pass
+    await reply(inter, content, ephemeral=True)
+
+
+# Replies with the first page and buttons for the rest when there is more than one
+async def sendPages(inter, pages):
+    if len(pages) == 1:
+        await reply(inter, pages[0])
+        return
+    view = Paginator(pages, inter.user.id)
+    if inter.response.is_done():
+        view.message = await inter.followup.send(pages[0], view=view, wait=True)
+    else:
+        await inter.response.send_message(pages[0], view=view)
+        view.message = await inter.original_response()
+
+
+# Answers an interaction with the pages built by render, a coroutine function returning a list of pages
+# A ValueError from render is shown to the user alone, same as a failed command, anything else gets a generic error
+# With a key the pages are cached for the guild until its data changes, so repeats skip the database
+# A render that outlasts DEFER_AFTER defers the interaction first so it cannot expire
+async def respondPages(inter, render, cache=None, key=None):
+    if cache is not None and key is not None:
+        pages = cache.get(inter.guild_id, key)
+        if pages is not None:
+            await sendPages(inter, pages)
+            return
+        version = cache.version(inter.guild_id)
+    task = asyncio.ensure_future(render())
+    done, _ = await asyncio.wait({task}, timeout=DEFER_AFTER)
+    if not done:
+        await inter.response.defer(thinking=True)
+    try:
+        pages = tuple(await task)
+    except ValueError as e:
+        await replyError(inter, str(e))
+        return
+    except Exception as e:
+        print(f'Rendering a reply failed: {e!r}')
+        await replyError(inter, 'Something went wrong, try again later')
+        return
+    if cache is not None and key is not None:
+        cache.store(inter.guild_id, version, key, pages)
+    await sendPages(inter, pages)